@@ -1,10 +1,6 @@
 import sys
-import pandas as pd
-import numpy as np
 import pygame
 import datetime
-from pySimio import *
-from experiment import create_map
 
 
 def make_button(picture, coords, surface):
@@ -75,6 +71,7 @@ def animate(map, time):
         pygame.display.update()
 
 if __name__ == "__main__":
+    from experiment import create_map
 
     b1 = [1, 1, 1, 1, 1, 1]
     b2 = [1, 1, 1, 1, 1, 1]
@@ -0,0 +1,330 @@
+import numpy as np
+import pandas as pd
+from experiment import create_map, experiment
+from fidelity import rank_correlation
+from optimization import METRICS, STATS, random_schedules
+from symmetry import canonical, canonical_key
+
+BOARDING = 2 / 60       # mean boarding time of one passenger (triangular(0, 1/60, 5/60), see variates.Variates)
+BLOCK = 180             # minutes per schedule entry and per arrival rate
+
+
+def leg_time(distance):
+    """ mean driving time (minutes) of a leg, as in Bus.depart: 20km/hr, uniform(5, 7) for the long legs """
+    return distance / 20 * 60 if distance < 2 else 6.0
+
+
+class Approximation:
+    """ Fluid approximation of Map.simulate, evaluating thousands of fleet schedules at once
+
+    The buses that serve a route during a 3-hour block are treated as one platoon: the simulation starts
+    them together and boarding keeps them bunched, so a stop sees the platoon once per cycle, with the
+    capacity of all its buses. Every `step` minutes, the people waiting for each OD pair (a fluid, with the
+    piecewise-constant arrival rates of the map) are offered to the platoons in the order of the stops; at
+    each stop the platoons serving fewer destinations board first, each one as many as its free space
+    allows, in proportion to the people waiting for each destination (boarding is first come, first
+    served). Loads are carried to the destinations, and the cycle time of a route is its mean driving
+    time plus the boarding time of the passengers of one bus. People board in arrival order, so the
+    cumulative arrival and boarding curves of each OD pair give the waiting times, the queue lengths and
+    the people who waited more than 120 minutes, as recorded at boarding by the simulation; waiting for
+    the next platoon adds half of the headway.
+
+    Everything is computed with numpy over the schedules, so a large batch costs tens of microseconds per
+    schedule, against about a second for the 10 replications of optimization.py.
+    The approximation ignores the variability of the arrivals and driving times and the route switch
+    points; see calibrate for how well it ranks schedules against the simulation.
+
+    Args:
+        model (Map) : map built by create_map; only its routes, stops, arrival rates and bus capacities are used
+        max_time (int) : duration time of the approximated runs
+        step (float) : time step (minutes) of the fluid recursion
+        dead_threshold (float) : waiting time (minutes) above which people are counted as dead
+    """
+    def __init__(self, model, max_time=60*18, step=10, dead_threshold=120):
+        self.max_time = max_time
+        self.step = step
+        self.steps = int(np.ceil(max_time / step))
+        self.dead_threshold = dead_threshold
+        self.routes = [route.num for route in model.routes]
+        self.capacity = np.array([bus.max_cap for bus in model.buses], dtype=float)
+        # stops in the order of the longest route, which passes every stop of the shorter ones in that order
+        longest = max(model.routes, key=lambda route: len(route.stops))
+        order = list(dict.fromkeys(longest.stops[:-1]))
+        order += [stop for stop in model.bus_stops.values() if stop not in order]
+        self.stops = [stop.name for stop in order]
+        # OD pairs and their arrival rates (# arrival / minute) per block
+        self.pairs = [(origin.name, dest.name) for origin in order for dest in origin.arrival_rates]
+        blocks = max(len(rates) for origin in order for rates in origin.arrival_rates.values())
+        self.rates = np.zeros((len(self.pairs), blocks))
+        for q, (origin, dest) in enumerate(self.pairs):
+            rates = model.bus_stops[origin].arrival_rates[model.bus_stops[dest]]
+            self.rates[q, :len(rates)] = np.asarray(rates, dtype=float) / 60
+        # route r: mean driving time of a cycle and, at each stop it visits, the mean time to the next stop
+        self.drive = np.array([sum(leg_time(d) for d in route.distances) for route in model.routes])
+        self.leg = [{route.stops[i].name: leg_time(d) for i, d in enumerate(route.distances)}
+                    for route in model.routes]
+        # stop -> platoons visiting it (fewer destinations first) with the OD pairs they board and alight there
+        self.visits = []
+        for stop in self.stops:
+            visits = []
+            for r, route in enumerate(model.routes):
+                names = [s.name for s in route.stops]
+                if stop in names:
+                    boards = [q for q, (o, d) in enumerate(self.pairs) if o == stop and d in names]
+                    alights = [q for q, (o, d) in enumerate(self.pairs) if d == stop and o in names]
+                    visits.append((r, boards, alights))
+            self.visits.append((stop, sorted(visits, key=lambda v: len(v[1]))))
+        self.serves = np.zeros((len(self.pairs), len(model.routes)))     # pair -> routes boarding it
+        for stop, visits in self.visits:
+            for r, boards, _ in visits:
+                self.serves[boards, r] = 1
+
+    def _arrays(self, schedules):
+        """ route index of every bus in every block, shape (schedules, buses, blocks) """
+        schedules = np.asarray(schedules, dtype=int)
+        if schedules.ndim == 2:
+            schedules = schedules[None]
+        index = np.full(max(self.routes) + 1, -1)
+        index[self.routes] = np.arange(len(self.routes))
+        return index[schedules]
+
+    def run(self, schedules, detail=False):
+        """ Fluid recursion of a batch of schedules
+        Args:
+            schedules (list) : route schedules of the buses (as passed to create_map) of one or more schedules
+            detail (bool) : if true, also keep the headways and the loads of every step
+        Returns:
+            dict of arrays, the schedules on the last axis: 'arrived' (cumulative arrival curves, the same
+            for every schedule, (steps + 1, pairs)), 'boarded' (cumulative boarding curves, (steps + 1, pairs,
+            schedules)), 'hw boarded' (headway waits of the boarded people),
+            'hw waiting' (people waiting for the next platoon, integrated over time), 'load' (platoon load
+            integrated over time) and, with detail, 'headway' (steps, stops, schedules) and 'loads'
+            (steps, routes, stops, schedules) departing each stop
+        """
+        routes = self._arrays(schedules)                                # (N, buses, blocks)
+        n, blocks = routes.shape[0], routes.shape[2]
+        counts = np.stack([(routes == r).sum(axis=1) for r in range(len(self.routes))])    # (routes, N, blocks)
+        capacity = np.stack([((routes == r) * self.capacity[:, None]).sum(axis=1) for r in range(len(self.routes))])
+        pairs, dt = len(self.pairs), self.step
+        arrived = np.zeros((self.steps + 1, pairs))
+        boarded = np.zeros((self.steps + 1, pairs, n))
+        hw_boarded = np.zeros((pairs, n))
+        hw_waiting = np.zeros((pairs, n))
+        load_time = np.zeros(n)
+        per_cycle = np.zeros((len(self.routes), n))                      # passengers boarded per bus and cycle
+        if detail:
+            headways = np.zeros((self.steps, len(self.stops), n))
+            loads_out = np.zeros((self.steps, len(self.routes), len(self.stops), n))
+        for j in range(self.steps):
+            t = j * dt
+            k = min(int(t / BLOCK), blocks - 1)                          # the last entry of a schedule is kept
+            rate = self.rates[:, int(t / BLOCK)] if int(t / BLOCK) < self.rates.shape[1] else np.zeros(pairs)
+            buses = counts[:, :, k]
+            cycle = self.drive[:, None] + per_cycle * BOARDING
+            visit = np.where(buses > 0, 1 / cycle, 0)                    # platoon visits per minute
+            offered = rate[:, None] + (arrived[j][:, None] - boarded[j]) / dt      # people to board per minute
+            remaining = offered.copy()
+            load = [{} for _ in self.routes]                             # pair -> people on the platoon
+            onboard = np.zeros((len(self.routes), n))
+            per_cycle = np.zeros((len(self.routes), n))
+            for s, (stop, visits) in enumerate(self.visits):
+                for r, boards, alights in visits:
+                    for q in alights:
+                        if q in load[r]:
+                            onboard[r] = np.maximum(onboard[r] - load[r].pop(q), 0)
+                    if boards:
+                        total = remaining[boards].sum(axis=0)
+                        taken = np.minimum(visit[r] * (capacity[r, :, k] - onboard[r]), total)
+                        share = np.divide(taken, total, out=np.zeros(n), where=total > 0)
+                        for q in boards:
+                            take = remaining[q] * share
+                            remaining[q] -= take
+                            load[r][q] = load[r].get(q, 0) + take * cycle[r]        # per platoon visit
+                        onboard[r] += taken * cycle[r]
+                        per_cycle[r] += taken * cycle[r]
+                    if stop in self.leg[r]:
+                        load_time += onboard[r] * (self.leg[r][stop] * dt) * visit[r]
+                    if detail:
+                        loads_out[j, r, s] = onboard[r]
+                if detail:
+                    rate_s = sum(visit[r] for r, _, _ in visits)
+                    headways[j, s] = np.divide(1, rate_s, out=np.full(n, np.inf), where=rate_s > 0)
+            served = offered - remaining
+            frequency = self.serves @ visit                              # platoon visits serving each pair
+            per_cycle = np.divide(per_cycle, buses, out=np.zeros_like(per_cycle), where=buses > 0)
+            headway_wait = np.divide(0.5, frequency, out=np.zeros((pairs, n)), where=frequency > 0)
+            arrived[j + 1] = arrived[j] + rate * dt
+            boarded[j + 1] = boarded[j] + served * dt
+            hw_boarded += served * dt * headway_wait
+            hw_waiting += rate[:, None] * dt * headway_wait
+        out = {'arrived': arrived, 'boarded': boarded, 'hw boarded': hw_boarded, 'hw waiting': hw_waiting,
+               'load': load_time}
+        if detail:
+            out['headway'] = headways
+            out['loads'] = loads_out
+        return out
+
+    def _waiting(self, arrived, boarded):
+        """ total waiting time of the people boarded by the end, time integral of the queue, and number of dead
+        people, for each pair """
+        dt = self.step
+        end = self.steps * dt
+        grid = np.arange(self.steps + 1) * dt
+        lag = int(round(self.dead_threshold / dt))
+        waited, area, dead = (np.zeros(boarded.shape[1:]) for _ in range(3))
+        for q in range(arrived.shape[1]):
+            curve = arrived[:, q]
+            queue = curve[:, None] - boarded[:, q]
+            area[q] = (queue[1:] + queue[:-1]).sum(axis=0) * dt / 2
+            # people still waiting at the end arrived after t*, where the arrival curve reaches the boarded ones
+            integral = np.concatenate(([0], np.cumsum((curve[1:] + curve[:-1]) * dt / 2)))
+            last = boarded[-1, q]
+            t_star = np.interp(last, curve, grid)
+            i = np.clip(np.searchsorted(grid, t_star, side='right') - 1, 0, self.steps - 1)
+            partial = integral[i] + (t_star - grid[i]) * (curve[i] + last) / 2
+            waited[q] = area[q] - (integral[-1] - partial - last * (end - t_star))
+            # people boarding at u are dead if they arrived before u - threshold: the boarding curve is then below
+            # the arrival curve shifted by the threshold (on the part of each step where it is)
+            gap = np.concatenate((np.zeros(lag), curve[:len(curve) - lag]))[:, None] - boarded[:, q]
+            before, after = gap[:-1], gap[1:]
+            fraction = np.clip(np.maximum(before, after) / np.maximum(np.abs(before - after), 1e-12), 0, 1)
+            fraction[(before > 0) & (after > 0)] = 1
+            dead[q] = (fraction * np.diff(boarded[:, q], axis=0)).sum(axis=0)
+        return waited, area, dead
+
+    def evaluate(self, schedules):
+        """ Approximate stats of a batch of schedules
+        Args:
+            schedules (list) : route schedules of the buses of one or more schedules
+        Returns:
+            dict of arrays, one value per schedule: the objectives of optimization.py ('avg_waiting_time',
+            'avg_queue_length', 'avg_occupancy', 'dead_people') and, for every stop with arrivals,
+            '<stop> waiting time total' and '<stop> avg people waiting'
+        """
+        result = self.run(schedules)
+        waited, area, dead = self._waiting(result['arrived'], result['boarded'])
+        boarded = result['boarded'][-1]
+        end = self.steps * self.step
+        out = {}
+        for stop in self.stops:
+            pairs = [q for q, (origin, _) in enumerate(self.pairs) if origin == stop]
+            if not pairs:
+                continue
+            people = boarded[pairs].sum(axis=0)
+            total = waited[pairs].sum(axis=0) + result['hw boarded'][pairs].sum(axis=0)
+            out[stop + ' waiting time total'] = np.divide(total, people, out=np.zeros_like(people), where=people > 0)
+            out[stop + ' avg people waiting'] = (area[pairs].sum(axis=0) + result['hw waiting'][pairs].sum(axis=0)) / end
+        out['avg_waiting_time'] = np.mean([v for name, v in out.items() if name.endswith('waiting time total')], axis=0)
+        out['avg_queue_length'] = np.mean([v for name, v in out.items() if name.endswith('avg people waiting')], axis=0)
+        out['avg_occupancy'] = result['load'] / (end * len(self.capacity))
+        out['dead_people'] = dead.sum(axis=0)
+        return out
+
+    def detail(self, routes_per_bus):
+        """ Expected headways, queue lengths, waiting times and bus loads of one schedule, per block and stop
+        Returns:
+            DataFrame with one row per block and stop: 'headway' (minutes between platoon visits), 'queue
+            length' (people waiting), 'waiting time' (of the people arriving in the block, by Little's law)
+            and 'route <r> load' (people on each bus of the route when it leaves the stop)
+        """
+        result = self.run(routes_per_bus, detail=True)
+        routes = self._arrays(routes_per_bus)[0]
+        queue = result['arrived'] - result['boarded'][:, :, 0]
+        per_step = self.step * np.arange(self.steps)
+        rows = []
+        for block in range(int(np.ceil(self.steps * self.step / BLOCK))):
+            steps = (per_step >= block * BLOCK) & (per_step < (block + 1) * BLOCK)
+            entry = min(block, routes.shape[1] - 1)
+            for s, stop in enumerate(self.stops):
+                pairs = [q for q, (origin, _) in enumerate(self.pairs) if origin == stop]
+                headway = result['headway'][steps, s, 0]
+                row = {'block': block, 'stop': stop,
+                       'headway': headway.mean() if np.isfinite(headway).all() else np.inf}
+                if pairs:
+                    backlog = (queue[:-1][steps][:, pairs] + queue[1:][steps][:, pairs]).sum(axis=1).mean() / 2
+                    rate = self.rates[pairs, block].sum() if block < self.rates.shape[1] else 0
+                    row['queue length'] = backlog + rate * (row['headway'] / 2 if np.isfinite(row['headway']) else 0)
+                    row['waiting time'] = row['queue length'] / rate if rate > 0 else np.nan
+                for r, number in enumerate(self.routes):
+                    buses = (routes[:, entry] == r).sum()
+                    if buses and any(v[0] == r for v in self.visits[s][1]):
+                        row['route {} load'.format(number)] = result['loads'][steps, r, s, 0].mean() / buses
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+
+def prefilter(approximation, schedules, objective, keep=0.1, audit=0.0, seed=0):
+    """ Candidates worth simulating: the best fraction `keep` of the schedules by their approximate value
+    Equivalent schedules (see symmetry.py) are kept once. A fraction `audit` of the other schedules is kept
+    at random as well, so that the calibration of the approximation can be checked on the simulated ones.
+    Args:
+        approximation (Approximation) : approximation of the map of the candidates
+        schedules (list) : candidate route schedules of the buses
+        objective (str) : objective of optimization.py, lower is better (e.g. 'avg_waiting_time')
+        keep (float or int) : fraction (or number, if at least 1) of the schedules kept
+        audit (float) : fraction of the other schedules kept at random
+        seed (int) : seed of the audit
+    Returns:
+        (kept schedules, their approximate values)
+    """
+    unique = list({canonical_key(routes): canonical(routes) for routes in schedules}.values())
+    values = approximation.evaluate(unique)[objective]
+    order = np.argsort(values, kind='stable')
+    count = int(keep) if keep >= 1 else max(1, int(np.ceil(keep * len(unique))))
+    rest = order[count:]
+    audited = np.random.RandomState(seed).choice(rest, int(round(audit * len(rest))), replace=False) if len(rest) else []
+    kept = list(order[:count]) + list(audited)
+    return [unique[i] for i in kept], values[kept]
+
+
+def calibrate(schedules, approximation=None, max_time=60*18, iteration=10, seed=0, executor=None, **map_args):
+    """ Calibration report of the approximation against Map.simulate
+    Args:
+        schedules (list) : route schedules of the buses, simulated and approximated
+        approximation (Approximation) : approximation to calibrate; default is built on the map of the first
+            schedule with the same max_time
+        max_time (int) : duration time for each simulation
+        iteration (int) : number of replications of each schedule (seeds seed, seed + 1, ...)
+        seed (int) : replication i uses seed + i
+        executor : executor from executor.py; default is a local process pool
+        **map_args : other arguments of create_map, e.g. aggregate=True
+    Returns:
+        DataFrame with one row per schedule and objective of optimization.py: 'schedule' (index in
+        schedules), 'objective', 'approximation' and 'simulation'; see summary
+    """
+    schedules = [canonical(routes) for routes in schedules]
+    if approximation is None:
+        approximation = Approximation(create_map(schedules[0], **map_args), max_time=max_time)
+    approximate = approximation.evaluate(schedules)
+    models = [create_map(routes, name=str(k), **map_args) for k, routes in enumerate(schedules)]
+    stats = experiment(models, max_time, iteration, output_report=False, printing=False, seed=seed,
+                       executor=executor, metrics=sorted(set(sum(STATS.values(), []))))
+    rows = []
+    for k in range(len(schedules)):
+        for objective, metric in METRICS.items():
+            rows.append({'schedule': k, 'objective': objective, 'approximation': approximate[objective][k],
+                         'simulation': metric(stats[stats['model'] == str(k)])})
+    return pd.DataFrame(rows)
+
+
+def summary(report):
+    """ For each objective of a calibration report: mean of the simulated and approximate values, mean
+    absolute and relative errors, the least squares line simulation ~ intercept + slope * approximation,
+    and the Spearman rank correlation, which tells whether the approximation can prefilter schedules """
+    rows = []
+    for objective, group in report.groupby('objective', sort=False):
+        x, y = group['approximation'].values, group['simulation'].values
+        error = np.abs(x - y)
+        slope, intercept = np.polyfit(x, y, 1) if len(x) > 1 and x.std() > 0 else (np.nan, np.nan)
+        rows.append({'objective': objective, 'schedules': len(group), 'simulation': y.mean(),
+                     'approximation': x.mean(), 'mean abs error': error.mean(),
+                     'mean rel error': (error / np.maximum(np.abs(y), 1e-12)).mean(),
+                     'intercept': intercept, 'slope': slope,
+                     'spearman': rank_correlation(x, y)})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    candidates = random_schedules(40, 6)
+    report = calibrate(candidates, aggregate=True)
+    print(summary(report))
@@ -1,5 +1,51 @@
+import os
+import hashlib
 import numpy as np
-import pandas as pd
+
+_rate_cache = {}    # (path, mtime, size) -> dict of parsed arrival rates
+
+
+def load_rates(path, cache_dir='cache'):
+    """load an arrival rate spreadsheet once and keep it in memory and in a binary cache
+    The binary cache is keyed by the content hash of the spreadsheet, so it is shared by every process
+    and invalidated when the spreadsheet changes. The returned arrays are read-only and shared by callers
+    Args:
+        path (str) : excel file of arrival rates, one column per OD pair
+        cache_dir (str) : directory of the binary cache, None to disable it
+    Returns:
+        dict of column name -> array of arrival rates (# arrival / hour)
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in _rate_cache:
+        return _rate_cache[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        cache_file = os.path.join(cache_dir, digest + '.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            rates = {k: data[k] for k in data.files}
+    else:
+        import pandas as pd    # Excel support is only needed when the cache misses
+        df = pd.read_excel(path)
+        rates = {k: df[k].values.astype(float) for k in df.select_dtypes('number').keys()}
+        if cache_file is not None:
+            # write then rename so that concurrent processes never read a partial file
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp.npz'.format(cache_file[:-4], os.getpid())
+            np.savez(tmp, **rates)
+            os.replace(tmp, cache_file)
+
+    for rate in rates.values():
+        rate.flags.writeable = False
+    _rate_cache[key] = rates
+    return rates
+
 
 def generate_arrival(rates, interval=180):
     """generate the data based on arrival rate (# arrival / hour)
@@ -21,19 +67,89 @@ def generate_arrival(rates, interval=180):
             c += 1
     return np.array(arrival_data)
 
+
+def generate_piecewise(rates, start=0, interval=180, rng=np.random):
+    """generate a poisson process with piecewise constant rates, from a start time until the rates exhaust
+    Args:
+        rates (list) : list of arrival rates (# arrival / hour), one per interval
+        start (float) : time from which to generate arrivals
+        interval (int) : number of minutes during which each rate applies
+        rng : random number generator, np.random or a np.random.RandomState
+    """
+    times = []
+    for block, rate in enumerate(rates):
+        lo, hi = max(block * interval, start), (block + 1) * interval
+        if hi <= lo or rate <= 0:
+            continue
+        n = rng.poisson(rate / 60 * (hi - lo))
+        times.append(np.sort(rng.uniform(lo, hi, n)))
+    return np.concatenate(times) if times else np.array([])
+
+
+def generate_window(rates, start, end, interval=180, rng=np.random):
+    """generate the arrivals of a poisson process in [start, end) when piecewise constant rates repeat
+    The rates cover len(rates) * interval minutes and start over afterwards, e.g. one service day
+    Args:
+        rates (list) : list of arrival rates (# arrival / hour), one per interval
+        start (float) : beginning of the window
+        end (float) : end of the window
+        interval (int) : number of minutes during which each rate applies
+        rng : random number generator, np.random or a np.random.RandomState
+    """
+    times = []
+    block = int(start // interval)
+    while block * interval < end:
+        lo, hi = max(block * interval, start), min((block + 1) * interval, end)
+        rate = rates[block % len(rates)]
+        if hi > lo and rate > 0:
+            n = rng.poisson(rate / 60 * (hi - lo))
+            times.append(np.sort(rng.uniform(lo, hi, n)))
+        block += 1
+    return np.concatenate(times) if times else np.array([])
+
+
+def generate_thinned(rate_sets, interval=180, rng=np.random):
+    """generate arrivals for several rate scenarios by thinning one shared stream
+    Within each interval a homogeneous stream is generated at the largest rate of all scenarios,
+    and each arrival is kept by scenario i with probability rate_i / largest rate, so the scenarios
+    share their randomness (common random numbers)
+    Args:
+        rate_sets (list) : list of lists of arrival rates (# arrival / hour), one per scenario
+        interval (int) : number of minutes during which each rate applies
+        rng : random number generator, np.random or a np.random.RandomState
+    Returns:
+        list of arrays of arrival times, one per scenario
+    """
+    n_blocks = max(len(rates) for rates in rate_sets)
+    rates = np.zeros((len(rate_sets), n_blocks))
+    for i, r in enumerate(rate_sets):
+        rates[i, :len(r)] = r
+    peak = rates.max(axis=0)
+    kept = [[] for _ in rate_sets]
+    for block in range(n_blocks):
+        if peak[block] <= 0:
+            continue
+        # homogeneous stream: poisson count, then sorted uniform times
+        n = rng.poisson(peak[block] / 60 * interval)
+        times = np.sort(rng.uniform(block * interval, (block + 1) * interval, n))
+        marks = rng.uniform(0, peak[block], n)
+        for i in range(len(rate_sets)):
+            kept[i].append(times[marks < rates[i, block]])
+    return [np.concatenate(k) if k else np.array([]) for k in kept]
+
 if __name__ == '__main__':
-    rates = pd.read_excel('data/ArrivalRates.xlsx')
+    rates = load_rates('data/ArrivalRates.xlsx')
     # weg - com
-    weg_com = generate_arrival(rates['Weg to Com'].values)
+    weg_com = generate_arrival(rates['Weg to Com'])
     # weg - ctown
-    weg_ctown = generate_arrival(rates['Weg to Ctown'].values)
+    weg_ctown = generate_arrival(rates['Weg to Ctown'])
     # com - ctown
-    com_ctown = generate_arrival(rates['Com to Ctown'].values)
+    com_ctown = generate_arrival(rates['Com to Ctown'])
     # com - weg
-    com_weg = generate_arrival(rates['Com to Weg'].values)
+    com_weg = generate_arrival(rates['Com to Weg'])
     # ctown - weg
-    ctown_weg = generate_arrival(rates['Ctown to Weg'].values)
+    ctown_weg = generate_arrival(rates['Ctown to Weg'])
     # ctown - com
-    ctown_com = generate_arrival(rates['Ctown to Com'].values)
+    ctown_com = generate_arrival(rates['Ctown to Com'])
 
     print(ctown_com)
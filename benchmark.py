@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import subprocess
+
+# run in a fresh interpreter: import a module, then report import time, peak memory and heavy modules loaded
+_PROBE = '''
+import sys, json, resource
+from time import perf_counter
+start = perf_counter()
+import {module}
+elapsed = perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss /= 1024                 # bytes on macOS, kilobytes elsewhere
+heavy = [m for m in ('pygame', 'pandas', 'openpyxl', 'matplotlib', 'seaborn', 'pysmac') if m in sys.modules]
+print(json.dumps({{'time': elapsed, 'rss': rss, 'heavy': heavy}}))
+'''
+
+
+def startup(modules=('numpy', 'pySimio', 'experiment', 'executor', 'sweep'), repeat=5):
+    """ Measure the startup cost of a worker process for each module
+    Each module is imported in a fresh interpreter `repeat` times.
+    Args:
+        modules (tuple) : names of the modules to import
+        repeat (int) : number of fresh interpreters per module
+    Returns:
+        dict of module -> {'time': best import time (s), 'rss': peak memory (MB), 'heavy': heavy modules loaded}
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module)], cwd=here,
+                                 capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        report[module] = {'time': min(r['time'] for r in runs),
+                          'rss': max(r['rss'] for r in runs) / 1024,
+                          'heavy': runs[0]['heavy']}
+    return report
+
+
+def variate_streams(n=100000):
+    """ Compare the cost of one boarding time drawn by a block-buffered stream and by a scalar numpy call
+    Returns:
+        dict of method -> nanoseconds per variate
+    """
+    import timeit
+    import numpy as np
+    from variates import VariateStream
+    stream = VariateStream(0, 'triangular', (0, 1/60, 5/60))
+    return {'VariateStream.next': 1e9 * timeit.timeit(stream.next, number=n) / n,
+            'np.random.triangular': 1e9 * timeit.timeit(lambda: np.random.triangular(0, 1/60, 5/60), number=n) / n}
+
+
+def transport(iteration=100, max_time=30):
+    """ Compare the wall time of an experiment whose workers return pickled stats or write shared memory
+    Returns:
+        dict of transport -> seconds
+    """
+    import contextlib
+    import io
+    from time import perf_counter
+    from experiment import create_map, experiment
+    models = [create_map([[1, 1, 1, 1, 1, 1]] * 7, name=str(k), aggregate=True) for k in range(4)]
+    report = {}
+    for method in ('pickle', 'shared'):
+        start = perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):     # the simulations print their wall time
+            experiment(models, max_time, iteration, output_report=False, printing=False, seed=0, transport=method)
+        report[method] = perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    print('{:<12} {:>10} {:>10}  {}'.format('module', 'import ms', 'peak MB', 'heavy modules loaded'))
+    for module, r in startup().items():
+        print('{:<12} {:>10.1f} {:>10.1f}  {}'.format(module, 1000 * r['time'], r['rss'], ', '.join(r['heavy']) or '-'))
+    print()
+    for method, ns in variate_streams().items():
+        print('{:<22} {:>8.0f} ns/variate'.format(method, ns))
+    print()
+    for method, seconds in transport().items():
+        print('{:<22} {:>8.2f} s'.format('transport ' + method, seconds))
@@ -0,0 +1,217 @@
+import os
+import contextlib
+import io
+import tempfile
+import numpy as np
+import histogram
+from experiment import create_map, experiment
+from journey import frame
+from prefix import PrefixCache
+from optimization import START as REFERENCE
+from store import Store, schedule_hash
+from symmetry import depot_departure, equivalent
+
+
+def _run(routes_per_bus, seed, max_time, **map_args):
+    """ stats of one replication of a schedule """
+    m = create_map(routes_per_bus, **map_args)
+    with contextlib.redirect_stdout(io.StringIO()):     # the simulation prints its wall time
+        m.simulate(max_time, seed=seed)
+    return m.collect_stats()
+
+
+def _differences(a, b):
+    """ names of the stats that differ between two collect_stats dicts """
+    return sorted(k for k in set(a) | set(b) if k not in a or k not in b or not np.array_equal(a[k], b[k]))
+
+
+def permutation(routes_per_bus=REFERENCE, seeds=(0, 1, 2), max_time=60*18, aggregate=False):
+    """ Check that a schedule and an equivalent permutation of it (see symmetry.py) give the same stats
+
+    The permutation moves the buses leaving the depot at t=0 before those leaving at t=1, keeping the order
+    within each departure time. The stats of a bus are named after its position, so they are compared
+    under the name of the same bus in the original schedule.
+    Args:
+        routes_per_bus (list) : route schedule of each bus; needs buses of both departure times
+        seeds (tuple) : seeds of the replications compared
+        max_time (int) : duration time of each simulation
+        aggregate (bool) : passed to create_map
+    Raises:
+        AssertionError if the stats of a replication differ
+    """
+    order = sorted(range(len(routes_per_bus)), key=lambda i: (depot_departure(routes_per_bus[i][0]), i))
+    permuted = [routes_per_bus[i] for i in order]
+    assert permuted != routes_per_bus and equivalent(permuted, routes_per_bus), 'no equivalent permutation to check'
+    names = {'Bus{}'.format(j + 1): 'Bus{}'.format(i + 1) for j, i in enumerate(order)}
+    for seed in seeds:
+        base = _run(routes_per_bus, seed, max_time, aggregate=aggregate)
+        stats = {}
+        for key, value in _run(permuted, seed, max_time, aggregate=aggregate).items():
+            first = key.split(' ')[0]
+            stats[names.get(first, first) + key[len(first):]] = value
+        diff = _differences(base, stats)
+        assert not diff, 'seed {}: permuted schedule differs on {}'.format(seed, diff)
+
+
+def aggregate(routes_per_bus=REFERENCE, seeds=(0, 1, 2), max_time=60*18, demand=1.0):
+    """ Check that aggregate passenger mode gives the same stats as the default mode (Person objects)
+    Args:
+        routes_per_bus (list) : route schedule of each bus
+        seeds (tuple) : seeds of the replications compared
+        max_time (int) : duration time of each simulation
+        demand (float) : passed to create_map; a high demand fills the buses, so people are left behind
+    Raises:
+        AssertionError if the stats of a replication differ
+    """
+    for seed in seeds:
+        diff = _differences(_run(routes_per_bus, seed, max_time, demand=demand),
+                            _run(routes_per_bus, seed, max_time, demand=demand, aggregate=True))
+        assert not diff, 'seed {}: aggregate mode differs on {}'.format(seed, diff)
+
+
+def variants(routes_per_bus=REFERENCE):
+    """ the schedule and, for each block k > 0, a copy with the route of one bus changed from block k on """
+    schedules = [routes_per_bus]
+    for k in range(1, len(routes_per_bus[0])):
+        routes = [list(r) for r in routes_per_bus]
+        j = k % len(routes)
+        routes[j][k:] = [routes[j][k] % 3 + 1] * (len(routes[j]) - k)
+        schedules.append(routes)
+    return schedules
+
+
+def prefix(schedules=None, seeds=(0, 1), max_time=60*18, aggregate=True):
+    """ Check that PrefixCache.run and PrefixCache.fork_run give the same stats as runs from time 0
+
+    The schedules are run twice through the cache, so that the second pass resumes every schedule from a
+    snapshot of its longest prefix.
+    Args:
+        schedules (list) : routes_per_bus of each schedule; default is variants()
+        seeds (tuple) : seeds of the replications compared
+        max_time (int) : duration time of each simulation
+        aggregate (bool) : passed to create_map
+    Raises:
+        AssertionError if the stats of a replication differ, or if no run resumed from a snapshot
+    """
+    schedules = schedules or variants()
+    cache = PrefixCache(max_time, aggregate=aggregate)
+    for seed in seeds:
+        base = [_run(routes, seed, max_time, aggregate=aggregate) for routes in schedules]
+        with contextlib.redirect_stdout(io.StringIO()):
+            runs = [cache.run(routes, seed) for _ in range(2) for routes in schedules]
+            forked = PrefixCache(max_time, aggregate=aggregate).fork_run(schedules, seed)
+        for j, stats in enumerate(runs + forked):
+            diff = _differences(base[j % len(schedules)], stats)
+            assert not diff, 'seed {}, schedule {}: {} differs on {}'.format(
+                seed, j % len(schedules), 'run' if j < len(runs) else 'fork_run', diff)
+    assert cache.skipped > 0, 'no run resumed from a snapshot'
+
+
+def store(schedules=None, iteration=2, max_time=60*3):
+    """ Check that the results store round-trips the replications of an experiment and stays idempotent
+
+    The models keep their default name (None), so only their position tells their replications apart. The
+    experiment is ingested first with one metric, then with all the stats, which completes the stored runs,
+    and then again, which adds nothing.
+    Args:
+        schedules (list) : routes_per_bus of each model; default is the first two of variants()
+        iteration (int) : number of replications of each model
+        max_time (int) : duration time of each simulation
+    Raises:
+        AssertionError if a replication is missing, stored under another schedule, or stored twice
+    """
+    schedules = schedules or variants()[:2]
+    models = [create_map(routes, aggregate=True) for routes in schedules]
+    st = Store(':memory:')
+    with contextlib.redirect_stdout(io.StringIO()):
+        experiment(models, max_time, iteration, output_report=False, printing=False, seed=0, store=st,
+                   metrics=['total dead people'])
+        df = experiment(models, max_time, iteration, output_report=False, printing=False, seed=0, store=st)
+    positions = [k for k in range(len(models)) for _ in range(iteration)]
+    assert st.ingest(df, models, max_time, seed=0, positions=positions) == 0, 'replications stored twice'
+    runs = st.metrics(['total dead people', 'total distance'])
+    assert len(runs) == len(models) * iteration, '{} runs stored instead of {}'.format(len(runs), len(df))
+    assert list(runs['schedule_hash']) == [schedule_hash(schedules[k]) for k in positions], 'wrong schedules'
+    for name in ('total dead people', 'total distance'):
+        assert np.array_equal(runs[name].values, df[name].values), 'stored {} differs'.format(name)
+    st.close()
+
+
+def journeys(schedules=None, iteration=2, max_time=60*6, demand=3.0):
+    """ Check that the journey logs of an experiment read back as the trips of its replications
+
+    The models keep their default name (None), so each needs a log of its own. A trip is logged when the
+    passenger alights, while dead people are counted at boarding, so the dead people of the log fall short
+    of the stat by at most the people still on board at the end, which the fleet capacity bounds.
+    Args:
+        schedules (list) : routes_per_bus of each model; default is the first two of variants()
+        iteration (int) : number of replications of each model
+        max_time (int) : duration time of each simulation
+        demand (float) : passed to create_map; a high demand leaves people waiting long enough to die
+    Raises:
+        AssertionError if a log is missing or its trips do not match the replications
+    """
+    schedules = schedules or variants()[:2]
+    models = [create_map(routes, aggregate=True, demand=demand) for routes in schedules]
+    with tempfile.TemporaryDirectory() as directory:
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = experiment(models, max_time, iteration, output_report=False, printing=False, seed=0,
+                            journeys=directory)
+        logs = sorted(os.listdir(directory))
+        assert logs == ['{}-None-0.jrnl'.format(k) for k in range(len(models))], 'logs {}'.format(logs)
+        for k, m in enumerate(models):
+            trips = frame(os.path.join(directory, logs[k]))
+            assert sorted(set(trips['run'])) == list(range(iteration)), 'model {}: runs of the log'.format(k)
+            assert set(trips['bus']) <= {bus.name for bus in m.buses}, 'model {}: buses of the log'.format(k)
+            assert (trips['board'] <= trips['alight']).all(), 'model {}: alighting before boarding'.format(k)
+            for i in range(iteration):
+                dead = (trips[trips['run'] == i]['waiting time'] > m.dead_threshold).sum()
+                missing = df['total dead people'][k * iteration + i] - dead
+                assert 0 <= missing <= sum(bus.max_cap for bus in m.buses), \
+                    'model {}, replication {}: {} dead people in the log'.format(k, i, dead)
+
+
+def histograms(routes_per_bus=REFERENCE, iteration=2, max_time=60*18):
+    """ Check that the histograms of an experiment are recorded only on request, give the dead people of the
+    stats and read back from the results store
+    Args:
+        routes_per_bus (list) : route schedule of each bus
+        iteration (int) : number of replications
+        max_time (int) : duration time of each simulation
+    Raises:
+        AssertionError if the histograms disagree with the stats or the store
+    """
+    m = create_map(routes_per_bus, aggregate=True)
+    st = Store(':memory:')
+    with contextlib.redirect_stdout(io.StringIO()):
+        plain = experiment([m], max_time, iteration, output_report=False, printing=False, seed=0)
+        df = experiment([m], max_time, iteration, output_report=False, printing=False, seed=0, histograms=True,
+                        store=st)
+    assert not [name for name in plain if name.endswith('histogram')], 'histograms recorded without request'
+    names = [name for name in df if name.endswith('waiting time histogram')]
+    for i, row in df.iterrows():
+        dead = histogram.dead_people(row, threshold=m.dead_threshold)
+        assert dead == row['total dead people'], 'replication {}: {} dead people in the histograms'.format(i, dead)
+        for name in names:
+            stored = st.histograms(name, seed=i)
+            assert np.array_equal(stored[name][0], row[name]), 'replication {}: stored {} differs'.format(i, name)
+            assert np.array_equal(stored['edges'][0], histogram.WAIT_EDGES), 'replication {}: edges'.format(i)
+    st.close()
+
+
+if __name__ == '__main__':
+    for mode in (False, True):
+        permutation(aggregate=mode)
+        print('permutation, aggregate={}: same stats'.format(mode))
+    for demand in (1.0, 3.0):
+        aggregate(demand=demand)
+        print('aggregate mode, demand={}: same stats'.format(demand))
+    for mode in (False, True):
+        prefix(aggregate=mode)
+        print('prefix cache, aggregate={}: same stats'.format(mode))
+    store()
+    print('results store: every replication stored once')
+    journeys()
+    print('journey logs: one per model, trips of every replication')
+    histograms()
+    print('histograms: same dead people as the stats, stored and read back')
@@ -0,0 +1,284 @@
+import os
+import sys
+import pickle
+import queue
+import threading
+import traceback
+import subprocess
+from contextlib import contextmanager
+from itertools import chain
+from multiprocessing import Pool
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from time import sleep
+from time import time as tf
+
+
+class SerialExecutor:
+    """ Runs every task in the calling process, one after another """
+    def map(self, fn, args):
+        return [fn(a) for a in args]
+
+    def close(self):
+        pass
+
+
+class PoolExecutor:
+    """ Runs tasks on a local multiprocessing pool
+
+    Args:
+        processes (int) : number of worker processes
+    """
+    def __init__(self, processes=None):
+        self.pool = Pool(processes)
+
+    def map(self, fn, args):
+        return self.pool.map(fn, args)
+
+    def close(self):
+        self.pool.terminate()
+
+
+def chunks(iteration, chunk=None):
+    """ (start, iteration) of the tasks running replications 0, ..., iteration - 1, at most chunk per task;
+    by default the replications are split evenly over the CPUs """
+    if chunk is None:
+        chunk = max(1, -(-iteration // (os.cpu_count() or 1)))
+    return [(start, min(chunk, iteration - start)) for start in range(0, iteration, chunk)]
+
+
+@contextmanager
+def owned(executor, processes=None):
+    """ the given executor, or a PoolExecutor of `processes` processes that is closed on exit, also when a
+    task raises """
+    if executor is not None:
+        yield executor
+        return
+    executor = PoolExecutor(processes)
+    try:
+        yield executor
+    finally:
+        executor.close()
+
+
+def run_chunked(fn, args, executor=None):
+    """ Run the tasks of args (e.g. one per range of chunks) and concatenate the lists of results they return
+    Args:
+        fn (function) : atomic process, a picklable function of one task returning a list
+        args (list) : tasks
+        executor : executor from executor.py; default is a local process pool with one process per task
+    """
+    with owned(executor, len(args)) as executor:
+        return list(chain(*executor.map(fn, args)))
+
+
+class RemoteError(Exception):
+    """ Traceback of an exception raised by a task on a worker, attached as the cause of the re-raised one """
+    def __str__(self):
+        return '\n' + self.args[0]
+
+
+class ClusterExecutor:
+    """ Coordinator handing seed ranges to worker processes over authenticated TCP connections
+
+    Tasks are the keyword-argument dicts of experiment.thread_process. Each task is split into units of
+    at most `chunk` replications; a unit carries the compact map specification recorded by create_map
+    (`Map.spec`) and its first replication index instead of a pickled Map. If a worker disconnects or
+    times out, its unit is put back in the queue and handed to another worker. If a unit raises, the worker
+    sends the exception back and map re-raises it; the units of that call still queued are dropped.
+    Messages are pickles, so connections are authenticated with a shared key (HMAC challenge, see
+    multiprocessing.connection) before anything is unpickled, and the coordinator only listens on this
+    machine unless another host is given.
+
+    Start a worker on another host, with the key of the coordinator in hex in PYSIMIO_AUTHKEY, with:
+        PYSIMIO_AUTHKEY=<key> python executor.py worker <coordinator host> <port>
+
+    Args:
+        host (str) : address to listen on; '0.0.0.0' accepts workers from other hosts
+        port (int) : port to listen on, 0 picks a free port
+        local_workers (int) : number of worker processes to spawn on this machine
+        chunk (int) : maximum number of replications sent to a worker at once
+        timeout (float) : seconds to wait for one unit before treating the worker as lost (None waits forever)
+        authkey (bytes) : key shared with the workers; default is a random key, in self.authkey
+    """
+    def __init__(self, host='127.0.0.1', port=0, local_workers=0, chunk=10, timeout=None, authkey=None):
+        self.chunk = chunk
+        self.timeout = timeout
+        self.authkey = os.urandom(32) if authkey is None else authkey
+        self.server = Listener((host, port), authkey=self.authkey)
+        self.address = self.server.address
+        self.pending = queue.Queue()    # units waiting for a worker
+        self.done = queue.Queue()       # (call, unit id, (ok, result or exception, traceback)) triples
+        self.call = 0                   # number of the current map call; units of earlier calls are dropped
+        self.workers = 0                # number of connected workers
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+        # spawn local workers, e.g. to test the protocol on one box
+        self.processes = []
+        connect_host = '127.0.0.1' if host in ('0.0.0.0', '') else host
+        env = dict(os.environ, PYSIMIO_AUTHKEY=self.authkey.hex())     # not on the command line, which is public
+        for _ in range(local_workers):
+            self.processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'worker', connect_host, str(self.address[1])],
+                cwd=os.path.dirname(os.path.abspath(__file__)), env=env))
+
+    def accept(self):
+        """ accept worker connections until the executor is closed """
+        while not self.closed:
+            try:
+                conn = self.server.accept()
+            except (AuthenticationError, EOFError):
+                continue                # wrong key: nothing from this peer is unpickled
+            except OSError:
+                return
+            with self.lock:
+                self.workers += 1
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        """ feed units to one worker; requeue the current unit if the worker is lost """
+        unit = None
+        try:
+            while not self.closed:
+                try:
+                    unit = self.pending.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if unit[0] != self.call:
+                    unit = None         # left over from a failed call
+                    continue
+                conn.send(unit[2:])
+                if not conn.poll(self.timeout):
+                    raise EOFError('worker timed out')
+                self.done.put((unit[0], unit[1], conn.recv()))
+                unit = None
+            conn.send(None)         # ask the worker to exit
+        except (OSError, EOFError, pickle.UnpicklingError):
+            if unit is not None:
+                self.pending.put(unit)
+        finally:
+            with self.lock:
+                self.workers -= 1
+            conn.close()
+
+    def map(self, fn, args):
+        # split each task into seed ranges
+        units = []
+        for t, a in enumerate(args):
+            model = a.get('model')
+            if model is not None and getattr(model, 'spec', None) is None:
+                raise ValueError('ClusterExecutor needs maps built by create_map')
+            task = {k: v for k, v in a.items() if k != 'model'}
+            if model is not None:
+                task['spec'] = model.spec
+            start = a.get('start', 0)
+            for first in range(start, start + a['iteration'], self.chunk):
+                unit = dict(task, start=first, iteration=min(self.chunk, start + a['iteration'] - first))
+                units.append((t, first, unit))
+
+        self.call += 1
+        for i, (t, first, unit) in enumerate(units):
+            self.pending.put((self.call, i, fn, unit))
+        try:
+            results = self.collect(len(units))
+        except BaseException:
+            self.call += 1              # workers drop the units of this call still queued
+            self.drain()
+            raise
+
+        out = [[] for _ in args]
+        for i, (t, first, unit) in enumerate(units):
+            out[t].extend(results[i])
+        return out
+
+    def collect(self, count):
+        """ results of the units of the current call, failing if no worker shows up for too long """
+        results = {}
+        idle = tf()
+        while len(results) < count:
+            try:
+                call, i, (ok, result, trace) = self.done.get(timeout=1)
+            except queue.Empty:
+                if self.workers > 0:
+                    idle = tf()
+                elif self.processes and all(p.poll() is not None for p in self.processes):
+                    raise RuntimeError('every local worker exited and no other worker is connected')
+                elif self.timeout is not None and tf() - idle > self.timeout:
+                    raise RuntimeError('no worker connected for {} seconds'.format(self.timeout))
+                continue
+            if call != self.call:
+                continue                # result of a unit of an earlier, failed call
+            if not ok:
+                raise result from RemoteError(trace)
+            results[i] = result
+        return results
+
+    def drain(self):
+        """ drop the queued units and the results not collected """
+        for q in (self.pending, self.done):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+
+    def close(self):
+        self.closed = True
+        self.server.close()
+        for p in self.processes:
+            try:
+                p.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                p.terminate()
+
+
+def worker(host, port, authkey=None, retries=50):
+    """ Worker loop: connect to a coordinator, run units until told to stop
+
+    Args:
+        host (str) : address of the coordinator
+        port (int) : port of the coordinator
+        authkey (bytes) : key of the coordinator; default is read in hex from PYSIMIO_AUTHKEY
+        retries (int) : number of connection attempts, 0.1s apart
+    """
+    if authkey is None:
+        if 'PYSIMIO_AUTHKEY' not in os.environ:
+            raise ValueError('set PYSIMIO_AUTHKEY to the key of the coordinator (ClusterExecutor.authkey in hex)')
+        authkey = bytes.fromhex(os.environ['PYSIMIO_AUTHKEY'])
+    for attempt in range(retries):
+        try:
+            conn = Client((host, port), authkey=authkey)
+            break
+        except OSError:
+            if attempt == retries - 1:
+                raise
+            sleep(0.1)
+    with conn:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                return
+            except Exception as e:      # e.g. the task function cannot be imported here
+                conn.send((False, RuntimeError(repr(e)), traceback.format_exc()))
+                continue
+            if msg is None:
+                return
+            fn, args = msg
+            try:
+                reply = (True, fn(args), None)
+            except Exception as e:
+                reply = (False, e, traceback.format_exc())
+                try:
+                    pickle.loads(pickle.dumps(e))      # the coordinator must be able to rebuild it
+                except Exception:
+                    reply = (False, RuntimeError(repr(e)), reply[2])
+            conn.send(reply)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'worker':
+        worker(sys.argv[2], int(sys.argv[3]))
+    else:
+        print('usage: PYSIMIO_AUTHKEY=<key> python executor.py worker <host> <port>')
@@ -1,10 +1,22 @@
 from pySimio import *
-import pandas as pd
-from multiprocessing import Pool
+import os
 from itertools import chain
+from arrival import load_rates
+from executor import owned
+from histogram import WAIT_EDGES, QUEUE_EDGES
 
 
-def create_map(routes_per_bus, arrival_data='data/ArrivalRates.xlsx', name=None):
+def create_map(routes_per_bus, arrival_data='data/ArrivalRates.xlsx', name=None, aggregate=False, demand=1.0):
+    """ Build the Ithaca map
+    Args:
+        routes_per_bus (list) : route schedule of each bus, e.g. [[1, 1, 1, 1, 1, 1], ...]
+        arrival_data (str or dict) : excel file of arrival rates (# arrival / hour) for every 3 hours,
+            or rates already loaded with arrival.load_rates
+        name (str) : name of the map
+        aggregate (bool) : if true, simulate passengers as counts instead of Person objects, with the same
+            stats; much faster for high demand or long horizons
+        demand (float) : multiplier applied to every arrival rate
+    """
 
     # create BusStop objects
     depot = BusStop('TDOG Depot')
@@ -15,11 +27,13 @@ def create_map(routes_per_bus, arrival_data='data/ArrivalRates.xlsx', name=None)
     ctown = BusStop('Collegetown')
 
     # feed arrival rate data to each bus stop
-    rates = pd.read_excel(arrival_data)
-    weg_east.add_data({com_east: rates['Weg to Com'].values, ctown: rates['Weg to Ctown'].values})
-    com_east.add_data({ctown: rates['Com to Ctown'].values})
-    com_west.add_data({weg_west: rates['Com to Weg'].values})
-    ctown.add_data({com_west: rates['Ctown to Com'].values, weg_west: rates['Ctown to Weg'].values})
+    rates = load_rates(arrival_data) if isinstance(arrival_data, str) else arrival_data
+    if demand != 1:
+        rates = {col: rate * demand for col, rate in rates.items()}
+    weg_east.add_data({com_east: rates['Weg to Com'], ctown: rates['Weg to Ctown']})
+    com_east.add_data({ctown: rates['Com to Ctown']})
+    com_west.add_data({weg_west: rates['Com to Weg']})
+    ctown.add_data({com_west: rates['Ctown to Com'], weg_west: rates['Ctown to Weg']})
 
     # route distance data
     r1d = [0.5, 2, 2, 2, 2, 0.5]
@@ -49,28 +63,93 @@ def create_map(routes_per_bus, arrival_data='data/ArrivalRates.xlsx', name=None)
         bus_list.append(Bus(name='Bus'+str(bus_num), route=eval('route'+str(start_route)), schedule=routes_per_hr))
         bus_num += 1
 
-    return Map([route1, route2, route3], bus_list,
-               {'TDOG Depot': depot, 'Wegmans-Eastbound': weg_east, 'Wegmans-Westbound': weg_west,
-                'Commons-Eastbound': com_east, 'Commons-Westbound': com_west, 'Collegetown': ctown}, name = name)
+    m = Map([route1, route2, route3], bus_list,
+            {'TDOG Depot': depot, 'Wegmans-Eastbound': weg_east, 'Wegmans-Westbound': weg_west,
+             'Commons-Eastbound': com_east, 'Commons-Westbound': com_west, 'Collegetown': ctown}, name = name,
+            aggregate=aggregate)
+    # compact definition of this map, used to rebuild it in other processes
+    m.spec = {'routes_per_bus': [[int(r) for r in routes] for routes in routes_per_bus],
+              'arrival_data': arrival_data, 'name': name, 'aggregate': aggregate, 'demand': demand}
+    return m
 
 
 def thread_process(models):
-    """ atomic process computed by each thread """
+    """ atomic process computed by each thread
+
+    Runs replications start, ..., start + iteration - 1 of a map given either as a Map object ('model')
+    or as the specification recorded by create_map ('spec'). With a seed, replication i uses seed + i.
+    With a bound (metric, budget), a replication is pruned as soon as the sum of the monotone metric
+    (see Map.partial_stats) over the replications run so far exceeds the budget; the remaining
+    replications are then skipped. With 'results' (see transport.SharedResults), the stats of replication
+    i are written in row row + i - start of the shared block instead of being returned. With 'histograms',
+    the stats also hold the histograms of Map.histograms. With 'journeys' (a directory), the trips are logged
+    in the journey log <index>-<model>-<start>.jrnl of that directory (see journey.py), with the replication as
+    run; 'index' is the position of the model in the experiment, so models with the same name do not share a log.
+    With 'metrics' (see Map.select), only the selected stats are kept, and returned as numbers and arrays.
+    """
     # retrieve the arguments from the keyword-arguments
-    m = models['model']
+    m = models['model'] if 'model' in models else create_map(**models['spec'])
     max_time = models['max_time']
     debug = models['debug']
     iteration = models['iteration']
+    start = models.get('start', 0)
+    seed = models.get('seed')
+    bound = models.get('bound')
+    window = models.get('window')
+    metrics = models.get('metrics')
+    previous = m.metrics
+    if metrics is not None:
+        m.metrics = metrics
+    edges = m.wait_edges, m.queue_edges
+    if models.get('histograms'):            # recorded only when they are returned
+        m.wait_edges = WAIT_EDGES if m.wait_edges is None else m.wait_edges
+        m.queue_edges = QUEUE_EDGES if m.queue_edges is None else m.queue_edges
+    log = None
+    if models.get('journeys') is not None:
+        from journey import JourneyLog
+        name = '{}-{}-{}.jrnl'.format(models.get('index', 0), m.name, start)
+        log = JourneyLog.for_map(os.path.join(models['journeys'], name), m)
+        m.journeys = log
+    shared = None
+    if 'results' in models:
+        from transport import SharedResults
+        shared = SharedResults.attach(models['results'])
 
     results = []
-    for i in range(iteration):
-        m.simulate(max_time, debug=debug)   # run simulation
+    spent = 0
+    for i in range(start, start + iteration):
+        monitor = None
+        if bound is not None:
+            metric, budget = bound
+            monitor = lambda time, partial: spent + partial[metric] > budget
+        if log is not None:
+            log.run = i
+        m.simulate(max_time, debug=debug, seed=None if seed is None else seed + i, monitor=monitor,
+                   window=window)   # run simulation
         # collect statistics
-        stats = m.collect_stats()
-        stats["model"] = m.name
+        stats = m.collect_stats(hourly=shared is None and metrics is None)
+        if shared is None and metrics is not None:
+            stats.update(m.hourly_stats())      # the selected series, as arrays
         stats['iteration']=i
+        if models.get('histograms'):
+            stats.update(m.histograms())
+        if shared is not None:
+            shared.write(models['row'] + i - start, stats, m.hourly_stats())
+        else:
+            stats["model"] = m.name
+            results.append(stats)
+        if bound is not None:
+            spent += m.partial[metric]
         m.reset()  # reset the simulation
-        results.append(stats)
+        if bound is not None and stats['pruned']:
+            break
+    if shared is not None:
+        shared.close()
+    if log is not None:
+        log.close()
+        m.journeys = None
+    m.metrics = previous
+    m.wait_edges, m.queue_edges = edges
     return results
 
 
@@ -78,7 +157,9 @@ def model_name(route):
     return str(route[0]) + str(route[1]) + str(route[2])
 
 
-def experiment(models, max_time, iteration, output_report=True, output='reports.csv', debug=False, printing=True):
+def experiment(models, max_time, iteration, output_report=True, output='reports.csv', debug=False, printing=True,
+               seed=None, executor=None, bound=None, window=None, transport='pickle', store=None, histograms=False,
+               journeys=None, metrics=None):
     """ Run the experiment with input models
     Args:
         models (list) : list of map objects
@@ -87,29 +168,81 @@ def experiment(models, max_time, iteration, output_report=True, output='reports.
         output_report (bool) : if true, generate csv file of simulation results
         output (str) : file name for the simulation output
         debug (bool) : if true, run simulation with DEBUG mode
+        seed (int) : if given, replication i of every model uses seed + i (common random numbers)
+        executor : SerialExecutor, PoolExecutor or ClusterExecutor from executor.py running the replications.
+            Default is a local process pool with one process per model
+        bound (tuple) : (metric, value) with a metric of Map.partial_stats, e.g. ('total dead people', 250).
+            The replications of a model stop as soon as its mean of that metric is certain to exceed value;
+            the returned rows then have 'pruned' set and hold partial statistics
+        window (float) : if given, generate arrivals lazily `window` minutes at a time, for horizons of
+            several days (see Map.simulate)
+        transport (str) : 'pickle' returns the stats of every replication from the workers as dicts;
+            'shared' sends the compact map specification (Map.spec) to the workers, which write the stats
+            in a preallocated shared memory block (see transport.SharedResults) that the returned DataFrame
+            wraps without copying. The 30-minute series are then columns of arrays instead of strings.
+            Workers must run on this machine
+        store (Store) : if given, the replications are added to this results store (see store.py)
+        histograms (bool) : if true, every row also holds the waiting time and queue length histograms of
+            the replication (see Map.histograms), as arrays of 3-hour block x bin; pickle transport only
+        journeys (str) : if given, a directory in which every worker writes the completed trips of its
+            replications to a memory-mapped journey log <index of the model>-<model name>-<first replication>.jrnl
+            (see journey.py); workers must share the file system
+        metrics (list) : if given, the names of the stats needed ('%' matches any text, e.g.
+            ['% waiting time total', 'total dead people']); the runs only keep the accumulators of these
+            stats and the DataFrame only has their columns, with the 30-minute series as arrays
     """
+    pd = load_pandas()
     assert(all(isinstance(model, Map) for model in models)), "models must be a list of Map objects"
+    if histograms and transport == 'shared':
+        raise ValueError("histograms are only returned with transport='pickle'")
+    if histograms and metrics is not None:
+        metrics = list(metrics) + ['% histogram']
     # begin simulations
     if printing:
         print("{} simulations with {} models begins ...".format(iteration, len(models)))
 
-    # shared variable to combine each simulation results
-    results = []
-    thread = Pool(len(models))  # initialize threads for each model
     # create keyword-arguments
-    args = [{'model': m, 'debug': debug, 'max_time': max_time, 'results': results, 'iteration': iteration}
+    args = [{'model': m, 'debug': debug, 'max_time': max_time, 'iteration': iteration, 'start': 0, 'seed': seed,
+             'bound': None if bound is None else (bound[0], bound[1] * iteration), 'window': window,
+             'histograms': histograms, 'journeys': journeys, 'index': i,
+             'metrics': metrics}
             for i, m in enumerate(models)]
-    stats = thread.map(thread_process, args)  # run multiprocessing
-    stats = list(chain(*stats))
-    thread.terminate()  # kill the thread
+    if transport == 'shared':
+        from transport import SharedResults, layout
+        names, series, bins = [], [], 0
+        for m in models:
+            m_metrics, m_series, bins = layout(m, max_time, window, monitored=bound is not None, metrics=metrics)
+            names += [k for k in m_metrics if k not in names]
+            series += [k for k in m_series if k not in series]
+        results = SharedResults(names, series, bins, len(models) * iteration)
+        for k, a in enumerate(args):
+            if getattr(a['model'], 'spec', None) is not None:
+                a['spec'] = a.pop('model').spec     # workers rebuild the map from its specification
+            a['results'] = results.spec()
+            a['row'] = k * iteration
+    try:
+        with owned(executor, len(models)) as pool:     # one process per model by default
+            stats = pool.map(thread_process, args)      # run multiprocessing
+    finally:
+        if transport == 'shared':
+            results.unlink()    # the block stays mapped in this process; its name is no longer needed
+    if transport == 'shared':
+        df = results.frame([m.name for m in models for _ in range(iteration)])
+        positions = np.repeat(np.arange(len(models)), iteration)[results.ran()].tolist()
+        results.close()
+    else:
+        df = pd.DataFrame(list(chain(*stats)))
+        positions = [k for k, s in enumerate(stats) for _ in s]     # position of the model of each row
     if printing:
-        print(pd.DataFrame(stats).groupby('model').mean())
+        print(df.groupby('model').mean(numeric_only=True))
         print("experiment done")
     # generate the file
     if output_report:
         out = 'reports/'
-        pd.DataFrame(stats).to_csv(out + output, index=False)
-    return pd.DataFrame(stats)
+        df.to_csv(out + output, index=False)
+    if store is not None:
+        store.ingest(df, models, max_time, seed=seed, window=window, positions=positions)
+    return df
 
 
 if __name__ == '__main__':
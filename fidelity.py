@@ -0,0 +1,252 @@
+import os
+import numpy as np
+import pandas as pd
+from experiment import create_map, experiment
+from executor import PoolExecutor, chunks, run_chunked
+from optimization import METRICS, STATS, START, random_schedules
+from prefix import PrefixCache
+from symmetry import canonical, canonical_key
+
+# default ladder, from cheap screening to the full evaluation of optimization.py
+LADDER = ({'horizon': 'changed', 'spill': 2, 'iteration': 2},
+          {'horizon': 60*18, 'iteration': 3},
+          {'horizon': 60*18, 'iteration': 10})
+
+# the same ladder after screening every candidate with the analytic approximation (see approximation.py),
+# which promotes the best 10%
+SCREENED = ({'approximation': True, 'keep': 0.1},) + LADDER
+
+
+def changed_horizon(routes_per_bus, reference, spill=2, block=180):
+    """ End of the last 3-hour block in which a schedule differs from the reference, plus spill blocks
+    Waiting times are recorded at boarding, so the queues left by a change only count once they are served
+    in the following blocks; without spill blocks a short horizon favours schedules that leave people waiting.
+    Args:
+        routes_per_bus (list) : route schedule of each bus
+        reference (list) : route schedule of each bus of the reference
+        spill (int) : number of blocks simulated after the last changed one
+        block (int) : minutes per schedule entry
+    Returns:
+        simulation length (int), at most the length of the schedule
+    """
+    changed = [k for routes, ref in zip(routes_per_bus, reference) for k, (r, s) in enumerate(zip(routes, ref)) if r != s]
+    return block * min(max(changed, default=0) + 1 + spill, len(reference[0]))
+
+
+def changed_process(args):
+    """ atomic process of a 'changed' level: the reference and a chunk of schedules over one horizon
+    The reference runs first and leaves a snapshot at every block boundary (see prefix.PrefixCache), so each
+    schedule resumes at the start of its first changed block and only simulates the blocks from there to the
+    horizon. Returns [(name, stats of each replication)] for the reference and the schedules, followed by
+    ('simulated', simulated minutes).
+    """
+    cache = PrefixCache(args['horizon'], **args['map_args'])
+    results = []
+    for name, routes in [('reference', args['reference'])] + args['schedules']:
+        results.append((name, [cache.run(routes, args['seed'] + i) for i in range(args['iteration'])]))
+    return results + [('simulated', cache.simulated)]
+
+
+def ranks(values):
+    """ ranks of the values, ties get their average rank """
+    values = np.asarray(values, dtype=float)
+    out = np.empty(len(values))
+    out[values.argsort(kind='stable')] = np.arange(len(values))
+    for v in np.unique(values):
+        out[values == v] = out[values == v].mean()
+    return out
+
+
+def rank_correlation(x, y):
+    """ Spearman rank correlation of two sequences of values; nan with fewer than 3 values or constant ranks """
+    if len(x) < 3:
+        return np.nan
+    a, b = ranks(x), ranks(y)
+    if a.std() == 0 or b.std() == 0:
+        return np.nan
+    return np.corrcoef(a, b)[0, 1]
+
+
+class MultiFidelity:
+    """ Evaluates schedules on a ladder of fidelity levels, from cheap screening to full evaluation
+
+    Each level is a dict with 'horizon' (minutes, or 'changed' for the blocks a schedule changes with
+    respect to the reference, followed by 'spill' blocks) and 'iteration' (number of replications).
+    Every level uses common random numbers, so replication i of every schedule uses seed + i, and equivalent
+    schedules (see symmetry.py) are evaluated once. On a 'changed' level, schedules have
+    different horizons; such a level scores the difference to the reference simulated over the same
+    horizon, which keeps the schedules of the level comparable. The blocks before the first change are the
+    same as those of the reference, so they are not simulated again: every schedule resumes from a snapshot
+    of the reference (see changed_process) and only its changed and spill blocks are simulated. A level
+    {'approximation': True} scores
+    schedules with the analytic approximation instead (see approximation.py), at no simulation cost; it
+    needs an objective of optimization.py. Every value is kept, so the rank correlation between levels can
+    be checked on the schedules evaluated at both.
+
+    Args:
+        metric (str or function) : name of an objective of optimization.py (e.g. 'avg_waiting_time') or a
+            function of the stats DataFrame; lower is better
+        levels (tuple) : fidelity levels, the last one is the full evaluation
+        reference (list) : route schedule of each bus compared with on 'changed' levels; without it,
+            'changed' levels use the horizon of the last level
+        seed (int) : replication i uses seed + i
+        executor : executor from executor.py; default is a local process pool
+        approximation (Approximation) : approximation of the approximation levels; default is built on the
+            map of the first schedules evaluated, with the horizon of the last level
+        **map_args : other arguments of create_map, e.g. aggregate=True
+    """
+    def __init__(self, metric, levels=LADDER, reference=None, seed=0, executor=None, approximation=None,
+                 **map_args):
+        self.objective = metric if isinstance(metric, str) else None
+        self.metric = METRICS[metric] if isinstance(metric, str) else metric
+        self.stats = STATS[metric] if isinstance(metric, str) else None    # stats the runs keep (see Map.select)
+        self.levels = list(levels)
+        self.reference = reference
+        self.seed = seed
+        self.approximation = approximation
+        self.map_args = map_args
+        self.own_executor = executor is None
+        self.executor = PoolExecutor(os.cpu_count()) if executor is None else executor
+        self.values = [{} for _ in self.levels]       # level -> canonical_key of schedule -> value
+        self.cost = [0 for _ in self.levels]          # simulated minutes spent on each level
+        self.references = {}                          # (horizon, iteration) -> value of the reference
+
+    def horizon(self, routes_per_bus, level):
+        spec = self.levels[level]
+        if spec.get('approximation'):
+            return self.levels[-1]['horizon']
+        if spec['horizon'] != 'changed':
+            return spec['horizon']
+        if self.reference is None:
+            return self.levels[-1]['horizon']
+        return changed_horizon(canonical(routes_per_bus), canonical(self.reference), spec.get('spill', 2))
+
+    def evaluate(self, schedules, level):
+        """ Evaluate schedules on a level; schedules already evaluated on it are not simulated again
+        Args:
+            schedules (list) : route schedules of the buses, as passed to create_map
+            level (int) : index of the level
+        Returns:
+            list of values, one per schedule
+        """
+        if self.levels[level].get('approximation'):
+            return self.approximate(schedules, level)
+        iteration = self.levels[level]['iteration']
+        relative = self.levels[level]['horizon'] == 'changed' and self.reference is not None
+        todo = {}
+        for routes in schedules:
+            if canonical_key(routes) not in self.values[level]:
+                todo.setdefault(self.horizon(routes, level), {})[canonical_key(routes)] = canonical(routes)
+        # one experiment per horizon; relative levels resume every schedule from the reference of that horizon
+        for horizon, group in todo.items():
+            if relative:
+                self.resume(group, horizon, level)
+                continue
+            models = [create_map(routes, name=str(k), **self.map_args) for k, routes in enumerate(group.values())]
+            stats = experiment(models, horizon, iteration, output_report=False, printing=False, seed=self.seed,
+                               executor=self.executor, metrics=self.stats)
+            self.cost[level] += horizon * iteration * len(models)
+            for k, key in enumerate(group):
+                self.values[level][key] = self.metric(stats[stats['model'] == str(k)])
+        return [self.values[level][canonical_key(routes)] for routes in schedules]
+
+    def resume(self, group, horizon, level):
+        """ Evaluate the schedules of a 'changed' level over one horizon, resuming from the reference """
+        iteration = self.levels[level]['iteration']
+        schedules = [(str(k), routes) for k, routes in enumerate(group.values())]
+        args = [{'reference': canonical(self.reference), 'schedules': schedules[start:start + count],
+                 'horizon': horizon, 'iteration': iteration, 'seed': self.seed, 'map_args': self.map_args}
+                for start, count in chunks(len(schedules))]
+        results = run_chunked(changed_process, args, self.executor)
+        stats = {name: pd.DataFrame(runs) for name, runs in results if name not in ('reference', 'simulated')}
+        self.cost[level] += sum(minutes for name, minutes in results if name == 'simulated')
+        if (horizon, iteration) not in self.references:
+            self.references[(horizon, iteration)] = self.metric(pd.DataFrame(results[0][1]))
+        for k, key in enumerate(group):
+            self.values[level][key] = self.metric(stats[str(k)]) - self.references[(horizon, iteration)]
+
+    def approximate(self, schedules, level):
+        """ Evaluate schedules on an approximation level, all at once """
+        if self.objective is None:
+            raise ValueError('approximation levels need an objective of optimization.py, not a function')
+        if self.approximation is None:
+            from approximation import Approximation
+            self.approximation = Approximation(create_map(schedules[0], **self.map_args),
+                                               max_time=self.levels[-1]['horizon'])
+        todo = {canonical_key(routes): canonical(routes) for routes in schedules
+                if canonical_key(routes) not in self.values[level]}
+        if todo:
+            values = self.approximation.evaluate(list(todo.values()))[self.objective]
+            self.values[level].update(zip(todo, values))
+        return [self.values[level][canonical_key(routes)] for routes in schedules]
+
+    def correlation(self, low, high=None):
+        """ Spearman rank correlation between two levels over the schedules evaluated on both
+        Args:
+            low (int) : index of the cheaper level
+            high (int) : index of the other level; default is the last level
+        Returns:
+            (correlation, number of schedules); the correlation is nan with fewer than 3 schedules
+        """
+        high = len(self.levels) - 1 if high is None else high
+        common = [key for key in self.values[low] if key in self.values[high]]
+        return rank_correlation([self.values[low][key] for key in common],
+                                [self.values[high][key] for key in common]), len(common)
+
+    def report(self):
+        """ DataFrame with, for each level, the schedules evaluated, the simulated minutes spent and the rank
+        correlation with the next level and with the last level """
+        rows = []
+        for level, spec in enumerate(self.levels):
+            horizon = self.horizon(None, level) if spec.get('approximation') else spec['horizon']
+            row = {'level': level, 'horizon': horizon,
+                   'iteration': spec.get('iteration', 0),
+                   'schedules': len(self.values[level]), 'simulated minutes': self.cost[level]}
+            if level + 1 < len(self.levels):
+                row['corr next'], row['n next'] = self.correlation(level, level + 1)
+                row['corr last'], row['n last'] = self.correlation(level)
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def successive_halving(self, schedules, eta=3, audit=0.1):
+        """ Send only promising schedules to full fidelity
+
+        All schedules are evaluated on the first level; the best 1/eta of them (or the fraction 'keep' of the
+        level) go to the next level, and so on up to the last level. A fraction `audit` of the schedules that
+        are not promoted is promoted at random as well, so the correlation between levels is also measured
+        away from the best schedules.
+        Args:
+            schedules (list) : candidate route schedules of the buses
+            eta (int) : 1/eta of the schedules are promoted at each level
+            audit (float) : fraction of the other schedules promoted at random
+        Returns:
+            (best schedule, its value on the last level)
+        """
+        rng = np.random.RandomState(self.seed)
+        survivors = list({canonical_key(routes): routes for routes in schedules}.values())
+        for level in range(len(self.levels)):
+            values = self.evaluate(survivors, level)
+            if level == len(self.levels) - 1:
+                break
+            order = np.argsort(values, kind='stable')
+            spec = self.levels[level]
+            keep = -(-len(survivors) // eta) if 'keep' not in spec else int(np.ceil(spec['keep'] * len(survivors)))
+            keep = max(1, keep)
+            rest = order[keep:]
+            audited = rng.choice(rest, int(round(audit * len(rest))), replace=False) if len(rest) else []
+            survivors = [survivors[i] for i in list(order[:keep]) + list(audited)]
+        best = int(np.argmin(values))
+        return survivors[best], values[best]
+
+    def close(self):
+        if self.own_executor:
+            self.executor.close()
+
+
+if __name__ == '__main__':
+    candidates = random_schedules(27, 3)
+    mf = MultiFidelity('avg_waiting_time', reference=START, aggregate=True)
+    best, value = mf.successive_halving(candidates)
+    mf.close()
+    print('best schedule', best, 'value', value)
+    print(mf.report())
@@ -0,0 +1,70 @@
+import numpy as np
+
+# default bin edges; the last bin of each is open-ended
+WAIT_EDGES = [float(e) for e in range(0, 301, 5)] + [float('inf')]     # waiting time (minutes)
+QUEUE_EDGES = [float(e) for e in range(0, 2001, 10)] + [float('inf')]  # number of people waiting
+
+
+def _totals(counts):
+    """ sum a histogram over its leading axes (e.g. 3-hour blocks, OD pairs, replications) """
+    counts = np.asarray(counts, dtype=float)
+    return counts.reshape(-1, counts.shape[-1]).sum(axis=0)
+
+
+def count_above(counts, edges, threshold):
+    """ Number of observations above a threshold, e.g. people who waited more than 60 minutes
+    Bins entirely above the threshold count fully; the bin containing it counts in proportion to the part
+    of the bin above it (exact when the threshold is an edge).
+    Args:
+        counts (array) : histogram, bins on the last axis
+        edges (list) : bin edges, len(edges) = bins + 1
+        threshold (float) : threshold in the unit of the edges
+    """
+    totals = _totals(counts)
+    edges = np.asarray(edges, dtype=float)
+    above = 0.0
+    for k, count in enumerate(totals):
+        lo, hi = edges[k], edges[k + 1]
+        if lo >= threshold:
+            above += count
+        elif hi > threshold:
+            above += count if np.isinf(hi) else count * (hi - threshold) / (hi - lo)
+    return above
+
+
+def quantile(counts, edges, q):
+    """ q-quantile of the observations, interpolated linearly within its bin, e.g. q=0.95 for the 95th percentile
+    A quantile in the open last bin is reported as the lower edge of that bin.
+    """
+    totals = _totals(counts)
+    total = totals.sum()
+    if total == 0:
+        return np.nan
+    cumulative = np.cumsum(totals)
+    k = int(np.searchsorted(cumulative, q * total))
+    k = min(k, len(totals) - 1)
+    lo, hi = edges[k], edges[k + 1]
+    if np.isinf(hi):
+        return lo
+    before = cumulative[k] - totals[k]
+    return lo + (hi - lo) * (q * total - before) / totals[k] if totals[k] else lo
+
+
+def mean(counts, edges):
+    """ mean of the observations, taking the middle of each bin (the lower edge for the open last bin) """
+    totals = _totals(counts)
+    edges = np.asarray(edges, dtype=float)
+    middles = np.where(np.isinf(edges[1:]), edges[:-1], (edges[:-1] + edges[1:]) / 2)
+    return (totals * middles).sum() / totals.sum() if totals.sum() else np.nan
+
+
+def dead_people(histograms, edges=WAIT_EDGES, threshold=120):
+    """ Number of people who waited more than threshold minutes, from the waiting time histograms of a run
+    Args:
+        histograms (dict) : name -> histogram, e.g. Map.histograms() or a row of experiment(histograms=True);
+            entries that are not waiting time histograms are ignored
+        edges (list) : waiting time bin edges of the run
+        threshold (float) : minutes
+    """
+    return sum(count_above(h, edges, threshold) for name, h in histograms.items()
+               if name.endswith('waiting time histogram') and isinstance(h, np.ndarray))
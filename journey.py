@@ -0,0 +1,133 @@
+import os
+import json
+import struct
+import numpy as np
+from pySimio import load_pandas
+
+# one fixed-width record per completed trip
+JOURNEY = np.dtype([('run', '<u4'), ('origin', '<u2'), ('destination', '<u2'), ('bus', '<u2'), ('seated', 'u1'),
+                    ('pad', 'u1'), ('arrival', '<f8'), ('board', '<f8'), ('alight', '<f8')])
+
+_MAGIC = b'PYSJRNL1'
+_HEADER = 4096                  # magic, number of records, length of the names, names (json); records follow
+
+
+def _names(path):
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER)
+    if header[:8] != _MAGIC:
+        raise ValueError('{} is not a journey log'.format(path))
+    count, length = struct.unpack_from('<QQ', header, 8)
+    return count, json.loads(header[24:24 + length].decode())
+
+
+class JourneyLog:
+    """ Log of the completed trips of the passengers, in a memory-mapped file
+
+    Every passenger who alights is one fixed-width record (see JOURNEY): replication, origin and destination
+    stop ids, bus id, whether they were seated when they alighted, and the times they arrived at the stop,
+    boarded and alighted. Records are buffered and written `batch` at a time into a preallocated structured
+    array mapped on the file, which grows `chunk` records at a time. The header holds the number of records
+    and the stop and bus names of the ids, so `read` maps the records without copying them.
+
+    Set `Map.journeys` to a log before simulating; works in both the default and the aggregate mode.
+    A log cannot be pickled, so runs that are copied (snapshots, rare events) must not have one.
+
+    Args:
+        path (str) : file of the log, overwritten
+        stops (list) : names of the stops; the id of a stop is its index
+        buses (list) : names of the buses; the id of a bus is its index
+        batch (int) : number of records buffered before they are written
+        chunk (int) : number of records the file grows by
+    """
+    def __init__(self, path, stops, buses, batch=4096, chunk=1 << 16):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        names = json.dumps({'stops': list(stops), 'buses': list(buses)}).encode()
+        if 24 + len(names) > _HEADER:
+            raise ValueError('too many stop and bus names for the header of a journey log')
+        self.path = path
+        self.stops = {name: k for k, name in enumerate(stops)}
+        self.buses = {name: k for k, name in enumerate(buses)}
+        self.batch = batch
+        self.chunk = chunk
+        self.run = 0                # replication written in the records, set by the caller
+        self.buffer = []
+        self.count = 0              # records written in the file
+        self.capacity = 0
+        self.records = None
+        with open(path, 'wb') as f:
+            f.write(_MAGIC + struct.pack('<QQ', 0, len(names)) + names)
+            f.truncate(_HEADER)
+        self.grow(chunk)
+
+    @classmethod
+    def for_map(cls, path, m, **kwargs):
+        """ log with the stops and buses of a map """
+        return cls(path, list(m.bus_stops.keys()), [bus.name for bus in m.buses], **kwargs)
+
+    def grow(self, records):
+        """ extend the file and its mapping by a number of records """
+        self.records = None         # unmap before resizing
+        self.capacity += records
+        with open(self.path, 'r+b') as f:
+            f.truncate(_HEADER + self.capacity * JOURNEY.itemsize)
+        self.records = np.memmap(self.path, dtype=JOURNEY, mode='r+', offset=_HEADER, shape=(self.capacity,))
+
+    def append(self, origin, destination, bus, seated, arrival, board, alight):
+        """ buffer the record of one trip (stops and bus are given by name) """
+        self.buffer.append((self.run, self.stops[origin], self.stops[destination], self.buses[bus], seated, 0,
+                            arrival, board, alight))
+        if len(self.buffer) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """ write the buffered records and their number """
+        if self.buffer:
+            n = len(self.buffer)
+            while self.count + n > self.capacity:
+                self.grow(self.chunk)
+            self.records[self.count:self.count + n] = np.array(self.buffer, dtype=JOURNEY)
+            self.count += n
+            self.buffer = []
+        self.records.flush()
+        with open(self.path, 'r+b') as f:
+            f.seek(8)
+            f.write(struct.pack('<Q', self.count))
+
+    def close(self):
+        """ flush and trim the file to the records written """
+        self.flush()
+        self.records = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(_HEADER + self.count * JOURNEY.itemsize)
+
+    def __getstate__(self):
+        raise TypeError('a JourneyLog cannot be pickled; set Map.journeys to None before copying a run')
+
+    @staticmethod
+    def read(path):
+        """ Records of a log, mapped read-only without copying
+        Returns:
+            (structured array of JOURNEY records, {'stops': names, 'buses': names})
+        """
+        count, names = _names(path)
+        if count == 0:
+            return np.zeros(0, dtype=JOURNEY), names
+        return np.memmap(path, dtype=JOURNEY, mode='r', offset=_HEADER, shape=(count,)), names
+
+
+def frame(path):
+    """ DataFrame of the trips of a log, with stop and bus names and the waiting, in-vehicle and total times """
+    pd = load_pandas()
+    records, names = JourneyLog.read(path)
+    df = pd.DataFrame({'run': records['run'],
+                       'origin': np.array(names['stops'], dtype=object)[records['origin']],
+                       'destination': np.array(names['stops'], dtype=object)[records['destination']],
+                       'bus': np.array(names['buses'], dtype=object)[records['bus']],
+                       'seated': records['seated'].astype(bool),
+                       'arrival': records['arrival'], 'board': records['board'], 'alight': records['alight']})
+    df['waiting time'] = df['board'] - df['arrival']
+    df['in-vehicle time'] = df['alight'] - df['board']
+    df['journey time'] = df['alight'] - df['arrival']
+    return df
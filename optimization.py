@@ -1,6 +1,22 @@
-import pysmac
 import pickle
+import numpy as np
 from experiment import create_map, experiment
+from symmetry import canonical, canonical_key
+
+# starting point of the optimization (the default of every parameter below); bus 1 always serves route 1
+START = [[1, 1, 1, 1, 1, 1], [2, 2, 1, 1, 3, 1], [2, 1, 1, 1, 2, 3], [1, 2, 2, 1, 1, 1],
+         [3, 3, 2, 2, 3, 2], [1, 1, 2, 3, 2, 1], [1, 2, 2, 1, 1, 1]]
+
+# best value found so far for each objective; runs that cannot beat it are pruned
+incumbent = {}
+
+# if set to a prefix.PrefixCache, candidates resume from the snapshot of their longest evaluated prefix
+# (replications then use seeds 0, ..., 9 for every candidate)
+prefix = None
+
+# (canonical form of the schedules evaluated (see symmetry.py), metrics) -> stats, so equivalent schedules are
+# simulated once
+evaluated = {}
 
 
 def save_obj(obj, name):
@@ -13,12 +29,61 @@ def load_obj(name):
         return pickle.load(f)
 
 
+def waiting_time_metric(stats):
+    """ mean over the bus stops of the average waiting time """
+    return stats[stats.keys()[stats.keys().str.contains('waiting time total')]].mean().values.mean()
+
+
+def queue_length_metric(stats):
+    """ mean over the bus stops (except the depot and Wegmans-Westbound) of the average number of people waiting """
+    return stats[stats.keys()[stats.keys().str.contains('avg people waiting') & ~stats.keys().str.contains('Depot') & ~stats.keys().str.contains('Wegmans-Westbound')]].mean().values.mean()
+
+
+def occupancy_metric(stats):
+    """ mean over the buses of the average occupancy """
+    return stats[stats.keys()[stats.keys().str.contains('avg occupancy') & stats.keys().str.contains('Bus')]].mean().values.mean()
+
+
+def dead_people_metric(stats):
+    """ mean number of people who waited more than 120 minutes """
+    return stats['total dead people'].values.mean()
+
+
+# objective name -> function of the stats DataFrame returned by experiment
+METRICS = {'avg_waiting_time': waiting_time_metric, 'avg_queue_length': queue_length_metric,
+           'avg_occupancy': occupancy_metric, 'dead_people': dead_people_metric}
+
+# objective name -> stats its function reads, the only ones the runs of the objective keep (see Map.select)
+STATS = {'avg_waiting_time': ['% waiting time total'], 'avg_queue_length': ['% avg people waiting'],
+         'avg_occupancy': ['Bus% avg occupancy'], 'dead_people': ['total dead people']}
+
+
+def random_schedules(n, changes, seed=0, start=START):
+    """ Random candidate schedules around a schedule, e.g. to screen or calibrate against the optimization
+    Args:
+        n (int) : number of schedules
+        changes (int) : number of random (bus, block) entries set to a random route in each schedule
+        seed (int) : seed of the random changes
+        start (list) : route schedule of each bus; bus 1 is never changed
+    Returns:
+        list of route schedules of the buses
+    """
+    rng = np.random.RandomState(seed)
+    schedules = []
+    for _ in range(n):
+        routes = [list(r) for r in start]
+        for _ in range(changes):
+            routes[rng.randint(1, len(routes))][rng.randint(len(routes[0]))] = rng.randint(1, 4)
+        schedules.append(routes)
+    return schedules
+
+
 def generate_simulation_result(x21, x22, x23, x24, x25, x26,
                                x31, x32, x33, x34, x35, x36,
                                x41, x42, x43, x44, x45, x46,
                                x51, x52, x53, x54, x55, x56,
                                x61, x62, x63, x64, x65, x66,
-                               x71, x72, x73, x74, x75, x76):
+                               x71, x72, x73, x74, x75, x76, bound=None, metrics=None):
     b1 = [1, 1, 1, 1, 1, 1]
     b2 = [x21, x22, x23, x24, x25, x26]
     b3 = [x31, x32, x33, x34, x35, x36]
@@ -27,8 +92,19 @@ def generate_simulation_result(x21, x22, x23, x24, x25, x26,
     b6 = [x61, x62, x63, x64, x65, x66]
     b7 = [x71, x72, x73, x74, x75, x76]
 
-    model = create_map(routes_per_bus=[b1, b2, b3, b4, b5, b6, b7], name='model')
-    return experiment([model], 60*18, 10, output_report=False, printing=False)
+    routes = canonical([b1, b2, b3, b4, b5, b6, b7])
+    key = (canonical_key(routes), None if metrics is None else tuple(metrics))
+    if key in evaluated:
+        return evaluated[key]
+    if prefix is not None and bound is None:
+        stats = prefix.experiment(routes, 10)
+    else:
+        model = create_map(routes_per_bus=routes, name='model')
+        stats = experiment([model], 60*18, 10, output_report=False, printing=False, bound=bound, transport='shared',
+                           metrics=metrics)
+    if not ('pruned' in stats and stats['pruned'].any()):
+        evaluated[key] = stats      # pruned runs only hold partial statistics
+    return stats
 
 
 def avg_waiting_time(x21, x22, x23, x24, x25, x26,
@@ -43,8 +119,9 @@ def avg_waiting_time(x21, x22, x23, x24, x25, x26,
                                        x41, x42, x43, x44, x45, x46,
                                        x51, x52, x53, x54, x55, x56,
                                        x61, x62, x63, x64, x65, x66,
-                                       x71, x72, x73, x74, x75, x76)
-    return stats[stats.keys()[stats.keys().str.contains('waiting time total')]].mean().values.mean()
+                                       x71, x72, x73, x74, x75, x76,
+                                       metrics=STATS['avg_waiting_time'])
+    return waiting_time_metric(stats)
 
 
 def avg_queue_length(x21, x22, x23, x24, x25, x26,
@@ -59,8 +136,9 @@ def avg_queue_length(x21, x22, x23, x24, x25, x26,
                                        x41, x42, x43, x44, x45, x46,
                                        x51, x52, x53, x54, x55, x56,
                                        x61, x62, x63, x64, x65, x66,
-                                       x71, x72, x73, x74, x75, x76)
-    return stats[stats.keys()[stats.keys().str.contains('avg people waiting') & ~stats.keys().str.contains('Depot') & ~stats.keys().str.contains('Wegmans-Westbound')]].mean().values.mean()
+                                       x71, x72, x73, x74, x75, x76,
+                                       metrics=STATS['avg_queue_length'])
+    return queue_length_metric(stats)
 
 
 def avg_occupancy(x21, x22, x23, x24, x25, x26,
@@ -75,8 +153,9 @@ def avg_occupancy(x21, x22, x23, x24, x25, x26,
                                        x41, x42, x43, x44, x45, x46,
                                        x51, x52, x53, x54, x55, x56,
                                        x61, x62, x63, x64, x65, x66,
-                                       x71, x72, x73, x74, x75, x76)
-    return stats[stats.keys()[stats.keys().str.contains('avg occupancy') & stats.keys().str.contains('Bus')]].mean().values.mean()
+                                       x71, x72, x73, x74, x75, x76,
+                                       metrics=STATS['avg_occupancy'])
+    return occupancy_metric(stats)
 
 
 def dead_people(x21, x22, x23, x24, x25, x26,
@@ -91,11 +170,19 @@ def dead_people(x21, x22, x23, x24, x25, x26,
                                        x41, x42, x43, x44, x45, x46,
                                        x51, x52, x53, x54, x55, x56,
                                        x61, x62, x63, x64, x65, x66,
-                                       x71, x72, x73, x74, x75, x76)
-    return stats['total dead people'].values.mean()
+                                       x71, x72, x73, x74, x75, x76,
+                                       bound=('total dead people', incumbent['dead_people'])
+                                       if 'dead_people' in incumbent else None, metrics=STATS['dead_people'])
+    if 'pruned' in stats and stats['pruned'].any():
+        # dominated: the dead people counted before pruning already put the mean over the incumbent
+        return stats['total dead people'].sum() / 10
+    value = dead_people_metric(stats)
+    incumbent['dead_people'] = min(value, incumbent.get('dead_people', value))
+    return value
 
 
 if __name__ == "__main__":
+    import pysmac
 
     parameters = dict(
 
@@ -0,0 +1,166 @@
+import os
+import pickle
+import pandas as pd
+from collections import OrderedDict
+from experiment import create_map
+
+
+def blocks(routes_per_bus):
+    """ routes of all buses in each 3-hour block: the labels of the edges of the prefix trie """
+    return [tuple(int(routes[k]) for routes in routes_per_bus) for k in range(len(routes_per_bus[0]))]
+
+
+class PrefixCache:
+    """ Shares the simulation of common schedule prefixes between candidate schedules
+
+    Buses change routes only at 3-hour block boundaries, so under common random numbers two schedules
+    with the same first k blocks follow the same trajectory until the first event of block k. The cache
+    keeps a trie of the evaluated prefixes; each node holds, per seed, a pickled snapshot of the whole run
+    paused before the first event of the next block. A candidate resumes from the snapshot of its deepest
+    shared prefix instead of time 0, and the stats are the same as those of a run from time 0 with the
+    same seed. Snapshots are evicted least recently used first.
+
+    Args:
+        max_time (int) : duration time for each simulation
+        max_snapshots (int) : maximum number of snapshots kept
+        **map_args : other arguments of create_map (arrival_data, aggregate, demand)
+    """
+    def __init__(self, max_time, max_snapshots=1024, **map_args):
+        self.max_time = max_time
+        self.max_snapshots = max_snapshots
+        self.map_args = map_args
+        self.root = {'children': {}, 'snapshots': {}}
+        self.lru = OrderedDict()        # (node id, seed) -> node, least recently used first
+        self.simulated = 0              # simulated minutes
+        self.skipped = 0                # minutes resumed from snapshots instead of simulated
+
+    def resume(self, routes_per_bus, seed):
+        """ Map of a schedule, paused at the deepest stored boundary of its prefix (or just started)
+        Returns:
+            (map, nodes of the trie along the prefix, number of blocks already simulated)
+        """
+        path = [self.root]
+        depth, snapshot = 0, None
+        for k, block in enumerate(blocks(routes_per_bus)[:-1]):
+            node = path[-1]['children'].get(block)
+            if node is None:
+                break
+            path.append(node)
+            if seed in node['snapshots']:
+                depth, snapshot = k + 1, node['snapshots'][seed]
+                self.lru.move_to_end((id(node), seed))
+        if snapshot is None:
+            m = create_map(routes_per_bus, **self.map_args)
+            m.start(self.max_time, seed=seed)
+            return m, path, 0
+        m = pickle.loads(snapshot)
+        for bus, routes in zip(m.buses, routes_per_bus):
+            bus.schedule = list(routes)         # only the blocks after the shared prefix differ
+        self.skipped += 180 * depth
+        return m, path[:depth + 1], depth
+
+    def store(self, node, seed, m):
+        node['snapshots'][seed] = pickle.dumps(m, pickle.HIGHEST_PROTOCOL)
+        self.lru[(id(node), seed)] = node
+        while len(self.lru) > self.max_snapshots:
+            (_, old_seed), old = self.lru.popitem(last=False)
+            old['snapshots'].pop(old_seed, None)
+
+    def run(self, routes_per_bus, seed):
+        """ Stats of one replication of a schedule (see Map.collect_stats), as simulate(seed=seed) would give """
+        m, path, depth = self.resume(routes_per_bus, seed)
+        labels = blocks(routes_per_bus)
+        for k in range(depth + 1, len(labels)):
+            if 180 * k >= self.max_time:
+                break
+            m.run(until=180 * k)                # paused before the first event of block k
+            node = path[-1]['children'].setdefault(labels[k - 1], {'children': {}, 'snapshots': {}})
+            path.append(node)
+            self.store(node, seed, m)
+        m.run()
+        m.finish()
+        self.simulated += self.max_time - 180 * depth
+        return m.collect_stats()
+
+    def experiment(self, routes_per_bus, iteration, seed=0, name='model'):
+        """ Replications seed, ..., seed + iteration - 1 of a schedule, as a DataFrame like experiment """
+        stats = []
+        for i in range(iteration):
+            s = self.run(routes_per_bus, seed + i)
+            s['model'] = name
+            s['iteration'] = i
+            stats.append(s)
+        return pd.DataFrame(stats)
+
+    def fork_run(self, schedules, seed, processes=None):
+        """ One replication of several schedules, sharing prefixes through fork instead of snapshots
+
+        The run of the common prefix is simulated once; where the schedules diverge at a block boundary,
+        the process forks one child per group of schedules, which starts from the parent's memory
+        (copy-on-write) and runs in parallel. Only available where os.fork is (not on Windows).
+        Args:
+            schedules (list) : routes_per_bus of each schedule
+            seed (int) : seed of the replication
+            processes (int) : maximum number of children forked at once by each process
+        Returns:
+            list of stats, one per schedule
+        """
+        if not hasattr(os, 'fork'):
+            return [self.run(routes, seed) for routes in schedules]
+        labels = [blocks(routes) for routes in schedules]
+        results = [None] * len(schedules)
+        # schedules with a different first block have different starting routes: one tree per first block
+        groups = {}
+        for j, label in enumerate(labels):
+            groups.setdefault(label[0], []).append(j)
+        for group in groups.values():
+            m = create_map(schedules[group[0]], **self.map_args)
+            m.start(self.max_time, seed=seed)
+            for j, stats in self._fork(m, schedules, labels, group, 1, processes or os.cpu_count() or 1):
+                results[j] = stats
+        return results
+
+    def _fork(self, m, schedules, labels, group, k, processes):
+        """ run the schedules of group, which share blocks 0, ..., k-1, from a map that has not reached block k """
+        if len(group) == 1 or 180 * k >= self.max_time or k >= len(labels[group[0]]):
+            # the schedules of the group do not differ within the horizon
+            for bus, routes in zip(m.buses, schedules[group[0]]):
+                bus.schedule = list(routes)
+            m.run()
+            m.finish()
+            stats = m.collect_stats()
+            return [(j, stats) for j in group]
+        m.run(until=180 * k)
+        parts = {}
+        for j in group:
+            parts.setdefault(labels[j][k], []).append(j)
+        if len(parts) == 1:
+            return self._fork(m, schedules, labels, group, k + 1, processes)
+
+        out = []
+        parts = list(parts.values())
+        for wave in range(0, len(parts), processes):
+            children = []
+            for part in parts[wave:wave + processes]:
+                read, write = os.pipe()
+                pid = os.fork()
+                if pid == 0:                    # child: continue with this group only
+                    os.close(read)
+                    try:
+                        for bus, routes in zip(m.buses, schedules[part[0]]):
+                            bus.schedule = list(routes)
+                        data = pickle.dumps(self._fork(m, schedules, labels, part, k + 1, processes))
+                        with os.fdopen(write, 'wb') as f:
+                            f.write(data)
+                    finally:
+                        os._exit(0)
+                os.close(write)
+                children.append((pid, read))
+            for pid, read in children:
+                with os.fdopen(read, 'rb') as f:
+                    data = f.read()
+                os.waitpid(pid, 0)
+                if not data:
+                    raise RuntimeError('a forked simulation failed')
+                out += pickle.loads(data)
+        return out
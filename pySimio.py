@@ -1,13 +1,45 @@
 import numpy as np
-import pygame
 import datetime
-from time import sleep
-from arrival import generate_arrival
+from bisect import bisect_left, bisect_right
+from collections import deque
+from arrival import generate_arrival, generate_piecewise, generate_window
+from variates import Variates
 import re
 from time import time as tf
+# pygame is imported inside the animation methods only, so that the simulation core runs headless
+
+
+def load_pandas():
+    """ pandas, imported on first use: it is only needed to build reports, so worker processes that only
+    simulate never load it (see benchmark.py) """
+    import pandas
+    return pandas
+
+
+def time_bin(time, period=None, width=30):
+    """ index of the statistics bin (30 minutes wide by default) of a time; with a period, the bins of every
+    period are folded """
+    if period is None:
+        return int(time / width)
+    return int(time % period / width)
+
+
+def selection(metrics):
+    """ compiled patterns of the stat names in metrics ('%' matches any text), or None for every stat """
+    if metrics is None:
+        return None
+    metrics = [metrics] if isinstance(metrics, str) else metrics
+    return [re.compile('.*'.join(re.escape(part) for part in name.split('%'))) for name in metrics]
+
+
+def selected(name, patterns):
+    """ whether a stat name is selected by the patterns returned by selection """
+    return patterns is None or any(p.fullmatch(name) for p in patterns)
 
 
 class Event:
+    __slots__ = ('time', 'bus', 'bus_stop', 'type')
+
     def __init__(self, time, bus, bus_stop, event_type):
         self.time = time            # time at which the event occurs
         self.bus = bus              # bus object
@@ -20,7 +52,7 @@ class Event:
 
 
 class Map:
-    def __init__(self, routes, buses, bus_stops, name='Ithaca'):
+    def __init__(self, routes, buses, bus_stops, name='Ithaca', aggregate=False):
         self.name = name                    # name of this map
         self.routes = routes                # list of Route objects that the map provides
         self.buses = buses                  # list of Bus objects in this map
@@ -31,16 +63,68 @@ class Map:
         self.path_occupancy = {}            # origin -> destination -> list of occupancy
         self.path_travel = {}               # origin -> destination -> list of travels
         self.total_dead = 0
+        self.aggregate = aggregate          # if true, keep per-destination counts instead of Person objects
+        self.variate_block = 4096           # number of boarding/driving times drawn at once
+        self.variates = None                # random variate streams of the current run
+        self.monitored = False              # whether the last run had a monitor (see simulate)
+        self.pruned = False                 # whether the last run was stopped early by its monitor
+        self.end_time = 0                   # time at which the last run ended
+        self.partial = {}                   # last partial_stats computed for the monitor
+        self.max_time = 0                   # length of the current run
+        self.time = 0                       # clock of the current run
+        self.window = None                  # lazy arrival window of the current run (see simulate)
+        self.period = None                  # length of the repeating service day of a windowed run
+        self.dead_threshold = 120           # people waiting longer than this (minutes) count as dead
+        self.wait_edges = None              # bin edges of the waiting time histograms (e.g. WAIT_EDGES), None to skip
+        self.queue_edges = None             # bin edges of the queue length histograms (e.g. QUEUE_EDGES), None to skip
+        self.journeys = None                # JourneyLog recording the completed trips (see journey.py)
+        self.metrics = None                 # names of the stats the runs report ('%' matches any text), None for all
+        self.patterns = None                # compiled metrics, set by start
+        self.tracked = None                 # accumulators the selected stats need, set by start
+        for bus in self.buses:
+            bus.aggregate = aggregate
+        for bus_stop in self.bus_stops.values():
+            bus_stop.aggregate = aggregate
 
-    def simulate(self, max_time, debug=False, animate=False, **settings):
+    def simulate(self, max_time, debug=False, animate=False, seed=None, publisher=None, arrivals=None,
+                 monitor=None, checkpoint=60, window=None, **settings):
         """Run simulation of this map
         Args:
             max_time (float): number of minutes for which to run the simulation
             debug (boolean): whether or not to run the simulation in debug mode
             animate(boolean): whether or not to render an animation of the simulation
+            seed (int): if given, seed the random number generator so that the run is reproducible
+            publisher (SnapshotPublisher): if given, publish periodic snapshots of the state while running
+            arrivals (dict): if given, use these arrival times instead of generating them
+                (origin name -> destination name -> sorted arrival times)
+            monitor (callable): if given, called as monitor(time, partial) every `checkpoint` minutes with the
+                monotone metrics of partial_stats; returning True stops (prunes) the run
+            checkpoint (float): number of minutes between calls to monitor
+            window (float): if given, generate arrivals lazily, `window` minutes at a time, for long horizons.
+                Arrival rates and bus schedules then repeat every service day (3 hours per schedule entry)
+                and the 30-minute stats are folded into one day, so memory does not grow with max_time
             **settings: keyword-arguments specifying settings of the animation
         """
-        time = 0
+        self.start(max_time, seed=seed, arrivals=arrivals, animate=animate, window=window, **settings)
+        if publisher is not None:
+            publisher.reset()
+        self.run(debug=debug, animate=animate, publisher=publisher, monitor=monitor, checkpoint=checkpoint, **settings)
+        self.finish(publisher=publisher)
+
+    def start(self, max_time, seed=None, arrivals=None, animate=False, window=None, **settings):
+        """Initialize a run: random streams, event queue and arrivals (first step of simulate)"""
+        assert(not (animate and self.aggregate)), "animation requires Person objects; disable aggregate mode"
+        self.window = window
+        self.period = None if window is None else 180 * max(len(bus.schedule) for bus in self.buses)
+        self.select(self.metrics)
+        if seed is not None:
+            np.random.seed(seed)
+        # boarding and driving times come from block-buffered streams seeded from the same seed
+        self.variates = Variates(seed, self.variate_block)
+        for bus in self.buses:
+            bus.variates = self.variates
+            bus.dead_threshold = self.dead_threshold
+            bus.journeys = self.journeys
         # initialize the event queue
         for i, bus in enumerate(self.buses):
             if bus.route == self.routes[1]:         # buses on Route 2 must start at depot, then change
@@ -57,14 +141,59 @@ class Map:
 
         # draw bus stop (if animate) and generate new data
         for bus_stop in self.bus_stops.values():
-            bus_stop.generate_data(max_time)
+            bus_stop.period = self.period
+            bus_stop.wait_edges = self.wait_edges if 'waiting time histograms' in self.tracked else None
+            bus_stop.queue_edges = self.queue_edges if 'queue length histograms' in self.tracked else None
+            if arrivals is not None:
+                bus_stop.generate_data(max_time, times=arrivals.get(bus_stop.name, {}))
+            else:
+                bus_stop.generate_data(max_time, reseed=seed is None, window=window)
             if animate:
                 self.surface = settings['surface']
                 bus_stop.add_animation(settings['surface'], settings['coordinates'][bus_stop.name])
 
+        self.max_time = max_time
+        self.time = 0
+        self.monitored = False
+        self.pruned = False
+        self.end_time = max_time
+        self.next_check = None
+        self.wall_start = tf()
+
+    def run(self, debug=False, animate=False, publisher=None, monitor=None, checkpoint=60, pause=None, until=None,
+            **settings):
+        """Process events until the end of the run (second step of simulate)
+        Args:
+            pause (callable): if given, called as pause(map) after every event; returning True returns before
+                the end of the run, which can be continued by calling run again
+            until (float): if given, return before the first event at or after this time, e.g. a 3-hour
+                boundary where schedules may change routes; the run can be continued by calling run again
+            other arguments: see simulate
+        Returns:
+            True if the run ended, False if it was paused
+        """
+        if monitor is not None:
+            self.monitored = True
+            if self.next_check is None:
+                self.next_check = checkpoint
+        max_time = self.max_time
+        period = self.period
+        time = self.time
+        tracked = self.tracked
+        paths = 'paths' in tracked
+        buses = 'buses' in tracked
+        bus_hourly = 'bus hourly' in tracked
+        stops = 'stops' in tracked
+        stop_hourly = 'stop hourly' in tracked
+        # path stats are in the unit of 30min, over one service day for windowed runs
+        path_bins = int(max_time / 30) if period is None else int(min(max_time, period) / 30)
+
         # main loop
-        start = tf()
         while time < max_time:
+            if until is not None and min(e.time for e in self.event_queue) >= until:
+                self.time = time
+                return False
+
             if debug:                                                       # wait for user input to proceed
                 input()
                 for bus in self.buses:
@@ -83,38 +212,47 @@ class Map:
             time = next_event.time                                          # current event time
             delta_time = time - self.prev_time                              # time - time_lst to calculate the integral
 
-            hour = int(time / 30)                                           # update hour flag
+            hour = time_bin(time, period)                                   # update hour flag
             hour_3 = int(time / 180)                                        # update 3 hour flag
 
             # change routes every 3 hours
             if int(self.prev_time / 180) < hour_3:
                 for bus in self.buses:
-                    if hour_3 < len(bus.schedule):
+                    if period is not None:                                  # schedules repeat every day
+                        bus.request_route_change(self.routes[bus.schedule[hour_3 % len(bus.schedule)] - 1])
+                    elif hour_3 < len(bus.schedule):
                         bus.request_route_change(self.routes[bus.schedule[hour_3] - 1])
 
             if debug:                                                       # print the event
                 next_event.print_event()
 
-            # update the utility
-            for b in self.buses:
-                b.avg_occupancy += delta_time * len(b.passengers)                       # average occupancy of each bus
-                b.avg_standing += delta_time * max(len(b.passengers) - b.num_seats, 0)  # average people standing for each bus
-                if hour not in b.avg_occupancy_t.keys():
-                    b.avg_occupancy_t[hour] = 0
-                else:
-                    b.avg_occupancy_t[hour] += delta_time * len(b.passengers)
+            # update the utility (only the accumulators of the selected stats)
+            if buses:
+                for b in self.buses:
+                    b.avg_occupancy += delta_time * b.occupancy                       # average occupancy of each bus
+                    b.avg_standing += delta_time * max(b.occupancy - b.num_seats, 0)  # average people standing for each bus
+                    if not bus_hourly:
+                        continue
+                    if hour not in b.avg_occupancy_t.keys():
+                        b.avg_occupancy_t[hour] = 0
+                    else:
+                        b.avg_occupancy_t[hour] += delta_time * b.occupancy
 
             for bs in self.bus_stops.keys():
                 bs = self.bus_stops[bs]
-                bs.avg_num_waiting += delta_time * bs.num_waiting                 # average people waiting at each stop
+                if stops:
+                    bs.avg_num_waiting += delta_time * bs.num_waiting             # average people waiting at each stop
+                if bs.queue_edges is not None:
+                    bs.add_queue_time(self.prev_time, delta_time)                 # time spent at this queue length
 
-            for bs in self.bus_stops.keys():                                      # average people waiting at each hour
-                bs = self.bus_stops[bs]
-                if hour not in bs.avg_num_waiting_t.keys():
-                    bs.avg_num_waiting_t[hour] = 0
+            if stop_hourly:
+                for bs in self.bus_stops.keys():                                  # average people waiting at each hour
+                    bs = self.bus_stops[bs]
+                    if hour not in bs.avg_num_waiting_t.keys():
+                        bs.avg_num_waiting_t[hour] = 0
 
-                else:
-                    bs.avg_num_waiting_t[hour] += delta_time * bs.num_waiting_hr
+                    else:
+                        bs.avg_num_waiting_t[hour] += delta_time * bs.num_waiting_hr
 
             if time > max_time:
                 break
@@ -136,40 +274,147 @@ class Map:
                 self.event_queue.append(arv_event) # add arrival event to the queue
 
                 # update the stats between paths every time the buses depart
-                if next_event.bus_stop.name != arv_event.bus_stop.name:
+                if paths and next_event.bus_stop.name != arv_event.bus_stop.name:
                     if next_event.bus_stop.name not in self.path_occupancy.keys():
                         self.path_occupancy[next_event.bus_stop.name] = {}
                         self.path_travel[next_event.bus_stop.name] = {}
                     if arv_event.bus_stop.name not in self.path_occupancy[next_event.bus_stop.name].keys():
-                        self.path_occupancy[next_event.bus_stop.name][arv_event.bus_stop.name] = [0] * int(max_time / 30) # stats are in the unit of 30min
-                        self.path_travel[next_event.bus_stop.name][arv_event.bus_stop.name] = [0] * int(max_time / 30)    # stats are in the unit of 30min
+                        self.path_occupancy[next_event.bus_stop.name][arv_event.bus_stop.name] = [0] * path_bins
+                        self.path_travel[next_event.bus_stop.name][arv_event.bus_stop.name] = [0] * path_bins
 
                     self.path_occupancy[next_event.bus_stop.name][arv_event.bus_stop.name][hour] += next_event.bus.occupancy
                     self.path_travel[next_event.bus_stop.name][arv_event.bus_stop.name][hour] += 1
 
             self.prev_time = time # update the last event time
+            if publisher is not None:
+                publisher.publish(self, time)
+            # stop early if the monitor decides this run cannot be competitive
+            if monitor is not None and time >= self.next_check:
+                self.next_check = (int(time / checkpoint) + 1) * checkpoint
+                self.partial = self.partial_stats(time)
+                if monitor(time, self.partial):
+                    self.pruned = True
+                    self.end_time = time
+                    break
+            if pause is not None and pause(self):
+                self.time = time
+                return False
             # end of one event cycle
 
+        self.time = time
+        if monitor is not None and not self.pruned:
+            self.partial = self.partial_stats(max_time)
+        return True
+
+    def finish(self, publisher=None):
+        """Turn the accumulated utilities into averages (last step of simulate)"""
+
         # update the utility
         for b in self.buses:
-            b.avg_occupancy /= max_time
-            b.avg_standing /= max_time
+            b.avg_occupancy /= self.end_time
+            b.avg_standing /= self.end_time
             waiting_t = np.array([value for (key, value) in sorted(b.avg_occupancy_t.items())])
-            b.avg_occupancy_t = waiting_t/30
+            b.avg_occupancy_t = waiting_t/(30 * self.bin_visits(sorted(b.avg_occupancy_t)))
             self.total_dead += b.dead_people
 
         for bs in self.bus_stops.keys():
             bs = self.bus_stops[bs]
-            bs.avg_num_waiting /= max_time
+            bs.avg_num_waiting /= self.end_time
             waiting_t = bs.avg_num_waiting_t
             waiting_t = np.array([value for (key, value) in sorted(bs.avg_num_waiting_t.items())])
-            bs.avg_num_waiting_t = waiting_t/30
+            bs.avg_num_waiting_t = waiting_t/(30 * self.bin_visits(sorted(bs.avg_num_waiting_t)))
+
+        if self.journeys is not None:
+            self.journeys.flush()
+
+        if publisher is not None:
+            publisher.publish(self, self.end_time, done=True)
 
         print('Simulation complete')
-        print("Simulation Time : ", tf() - start)
+        print("Simulation Time : ", tf() - self.wall_start)
+
+    def histograms(self):
+        """ Called after the simulation to collect the histograms, as arrays of 3-hour block x bin:
+        number of people per waiting time bin for each OD pair (by the block in which they arrived), and
+        minutes spent per queue length bin for each stop (see wait_edges and queue_edges)
+        """
+        hists = {}
+        for bs in self.bus_stops.values():
+            if bs.wait_edges is not None:
+                for dest, rows in bs.wait_hist.items():
+                    hists[bs.name + "-" + dest + " waiting time histogram"] = np.array(rows, dtype=float)
+            if bs.queue_edges is not None and bs.queue_hist:
+                edges = np.array(bs.queue_edges, dtype=float)
+                hist = np.zeros((len(bs.queue_hist), len(edges) - 1))
+                for block, row in enumerate(bs.queue_hist):
+                    lengths = np.fromiter(row.keys(), dtype=float, count=len(row))
+                    minutes = np.fromiter(row.values(), dtype=float, count=len(row))
+                    np.add.at(hist[block], np.searchsorted(edges, lengths, side='right') - 1, minutes)
+                hists[bs.name + " queue length histogram"] = hist
+        return hists
+
+    def select(self, metrics):
+        """Select the stats reported by the runs and the accumulators they need, so that the others are not kept
+        Args:
+            metrics (list): names of the stats, '%' matches any text, e.g. ['% waiting time total'];
+                None for every stat
+        """
+        self.metrics = metrics
+        self.patterns = selection(self.metrics)
+        stops = list(self.bus_stops.keys())
+        pairs = [origin + "-" + dest for origin in stops for dest in stops if origin != dest]
+
+        def wants(names, suffixes):
+            return any(self.wants(name + suffix) for name in names for suffix in suffixes)
+
+        groups = {'paths': wants(pairs, (" avg occupancy", " hourly occupancy")),
+                  'buses': wants([bus.name for bus in self.buses], (" avg occupancy", " avg standing", " hourly occupancy")),
+                  'bus hourly': wants([bus.name for bus in self.buses], (" hourly occupancy",)),
+                  'stops': wants(stops, (" avg people waiting", " hourly people waiting")),
+                  'stop hourly': wants(stops, (" hourly people waiting",)),
+                  'waiting time histograms': wants(pairs, (" waiting time histogram",)),
+                  'queue length histograms': wants(stops, (" queue length histogram",))}
+        self.tracked = {group for group, needed in groups.items() if needed}
+
+    def wants(self, name):
+        """whether the runs report the stat name (see select)"""
+        return selected(name, self.patterns)
+
+    def bin_visits(self, bins):
+        """Number of days of the run covering each 30-minute bin (1 for each bin unless the run is windowed)"""
+        bins = np.array(bins, dtype=float)
+        if self.period is None:
+            return np.ones(len(bins))
+        return np.maximum(1, np.ceil((self.end_time - 30 * bins) / self.period))
+
+    def snapshot(self, time):
+        """Returns the current state of the simulation: queue lengths, bus positions and running metrics"""
+        boarded = sum(sum(bs.num_getoff.values()) for bs in self.bus_stops.values())
+        waited = sum(sum(bs.waiting_time.values()) for bs in self.bus_stops.values())
+        return {'time': time,
+                'queue length': {bs.name: bs.num_waiting for bs in self.bus_stops.values()},
+                'buses': {bus.name: {'route': bus.route.num, 'next stop': bus.next_stop.name,
+                                     'occupancy': bus.occupancy} for bus in self.buses},
+                'metrics': {'total dead people': sum(bus.dead_people for bus in self.buses),
+                            'total distance': sum(bus.distance for bus in self.buses),
+                            'people boarded': boarded,
+                            'waiting time total': waited / boarded if boarded else 0}}
+
+    def partial_stats(self, time):
+        """Returns metrics that can only grow during a run, so a partial value is a lower bound of the final one"""
+        waited = 0
+        for bs in self.bus_stops.values():
+            waited += sum(bs.waiting_time.values())                                  # people who boarded
+            if bs.aggregate:
+                waited += sum(time * len(q) - sum(q) for q in bs.queue_times.values())  # people still waiting
+            else:
+                waited += sum(time - person.start_time for person in bs.people_waiting)
+        return {'total dead people': sum(bus.dead_people for bus in self.buses),
+                'cumulative waiting time': waited}
 
     def update_clock(self, surface, elapsed):
         """Updated clock in bottom right corner of animation"""
+        import pygame
         width, height = 1080, 720
         clear = pygame.image.load('images/blank.png')
         clear_rect = clear.get_rect()
@@ -182,12 +427,13 @@ class Map:
         clock = font_med.render('Time: ' + str(current)[:5], 1, (255, 255, 255))
         surface.blit(clock, (width - 90, height - 30))
 
-    def collect_stats(self):
-        """ Called after the simulation to collect the stats"""
-        stats = {}
-        total_traveled = 0
+    def hourly_stats(self):
+        """ Called after the simulation to collect the 30-minute series of the stats, as arrays """
+        series = {}
+        # the last 30-minute bin lies past the end of the run, unless the bins of a windowed run are folded into a day
+        hourly = slice(None) if self.period is not None else slice(None, -1)
 
-        # stats for the occupancy rate between stops
+        # occupancy rate between stops
         for origin in self.path_occupancy.keys():
             for dest in self.path_occupancy[origin].keys():
                 time = []
@@ -196,7 +442,29 @@ class Map:
                         time.append(0)
                     else:
                         time.append(i/j)
-                stats[origin + "-" + dest + " hourly occupancy"] = re.split("\[ |\]", str(np.array(time)[:-1]))[1]
+                series[origin + "-" + dest + " hourly occupancy"] = np.array(time)[hourly]
+        for bus in self.buses:
+            series[bus.name + " hourly occupancy"] = bus.avg_occupancy_t[hourly]
+        for bs in self.bus_stops.values():
+            series[bs.name + " hourly people waiting"] = bs.avg_num_waiting_t[hourly]
+        if self.patterns is not None:
+            series = {name: values for name, values in series.items() if self.wants(name)}
+        return series
+
+    def collect_stats(self, hourly=True):
+        """ Called after the simulation to collect the stats selected by metrics (see select)
+        Args:
+            hourly (bool): if false, leave out the 30-minute series (see hourly_stats)
+        """
+        stats = {}
+        total_traveled = 0
+        series = self.hourly_stats() if hourly else {}
+
+        # stats for the occupancy rate between stops
+        for origin in self.path_occupancy.keys():
+            for dest in self.path_occupancy[origin].keys():
+                if origin + "-" + dest + " hourly occupancy" in series:
+                    stats[origin + "-" + dest + " hourly occupancy"] = re.split("\[ |\]", str(series[origin + "-" + dest + " hourly occupancy"]))[1]
                 if sum(self.path_travel[origin][dest]) != 0:
                     stats[origin + "-" + dest + " avg occupancy"] = sum(self.path_occupancy[origin][dest])/sum(self.path_travel[origin][dest])
 
@@ -206,13 +474,15 @@ class Map:
             total_traveled += bus.distance                          # traveling distance for all buses
             stats[bus.name + " avg occupancy"] = bus.avg_occupancy  # average occupancy for each buses
             stats[bus.name + " avg standing"] = bus.avg_standing    # average number of people standing for each bus
-            stats[bus.name + " hourly occupancy"] = re.split("\[ |\]", str(bus.avg_occupancy_t[:-1]))[1]
+            if bus.name + " hourly occupancy" in series:
+                stats[bus.name + " hourly occupancy"] = re.split("\[ |\]", str(series[bus.name + " hourly occupancy"]))[1]
 
         # stats for each bus stop
         for bs in self.bus_stops.keys():
             bs = self.bus_stops[bs]
             stats[bs.name + " avg people waiting"] = bs.avg_num_waiting  # avg. number of people waiting at each stop
-            stats[bs.name + " hourly people waiting"] = re.split("\[ |\]", str(bs.avg_num_waiting_t[:-1]))[1]
+            if bs.name + " hourly people waiting" in series:
+                stats[bs.name + " hourly people waiting"] = re.split("\[ |\]", str(series[bs.name + " hourly people waiting"]))[1]
             total_waiting = 0
             total_people = 0
             for dest in bs.waiting_time.keys():
@@ -226,12 +496,20 @@ class Map:
         # stats in the map
         stats['total distance'] = total_traveled  # total distance traveled
         stats['total dead people'] = self.total_dead
+        if self.patterns is not None:
+            stats = {name: value for name, value in stats.items() if self.wants(name)}
+        if self.monitored:
+            stats['pruned'] = self.pruned
+            stats['end time'] = self.end_time
         return stats
 
     def reset(self):
         """ reset simulation """
         self.prev_time = 0
         self.total_dead = 0
+        self.event_queue = []
+        self.path_occupancy = {}
+        self.path_travel = {}
         # reset the stats for each bus
         for bus in self.buses:
             bus.reset()
@@ -252,6 +530,7 @@ class Bus:
         next_stop (BusStop): A BusStop object denoting the next stop this bus will stop at.
 
         passengers (list): A list of Person objects representing the passengers on this bus.
+        counts (dict): Number of passengers per destination BusStop (aggregate mode only).
         occupancy (int): The number of people currently on this bus.
         num_seats(int): The number of seats on this bus.
         standing_cap(int): The number of people that can be standing on this bus.
@@ -266,6 +545,7 @@ class Bus:
 
         self.name = name
         self.route = route
+        self.start_route = route                       # route at the beginning of each simulation
         self.to_change = None                          # if current route is temporary, specify route to switch to
         self.change_tracker = [0, 0]                   # [distance travelled since checkpoint, distance to switch-point]
         self.schedule = schedule                       # list (e.g [1,1,1,1,2,2]) specifying route every 3 hrs
@@ -273,7 +553,9 @@ class Bus:
         self.next_stop_num = 1                             # bus starts at first stop, i.e. index 0
         self.next_stop = self.route.stops[1]
 
+        self.aggregate = False                             # if true, track counts per destination instead of Person objects
         self.passengers = []                               # bus starts with nobody on it
+        self.counts = {}                                   # destination -> number of passengers (aggregate mode)
         self.occupancy = 0
         self.num_seats = 25                                # default number of seats is 25
         self.standing_cap = 10                             # default standing capacity is 10
@@ -284,13 +566,26 @@ class Bus:
         self.avg_occupancy = 0
         self.avg_standing = 0
         self.dead_people = 0
+        self.dead_threshold = 120                          # people waiting longer than this (minutes) count as dead
         self.avg_occupancy_t = {}                          # hour -> average occupancy dict
+        self.variates = None                               # random variate streams, set by Map.simulate
+        self.journeys = None                               # JourneyLog of the completed trips, set by Map.start
+        self.riders = []                                   # (origin, destination, arrival, boarding time) in boarding
+                                                           # order (aggregate mode with a journey log)
 
         self.animate = False
         self.surface = None
         self.icon = None
         self.icon_rect = None,
 
+    def set_capacity(self, num_seats=None, standing_cap=None):
+        """Change the number of seats and/or the standing capacity, and the maximum capacity with them"""
+        if num_seats is not None:
+            self.num_seats = num_seats
+        if standing_cap is not None:
+            self.standing_cap = standing_cap
+        self.max_cap = self.num_seats + self.standing_cap
+
     def goes_to(self, stop):
         """Returns True if this bus goes to the specified stop and False otherwise"""
 
@@ -322,12 +617,14 @@ class Bus:
 
     def board(self, stop, time):
         """Models the process of people boarding this bus at a certain stop"""
+        if self.aggregate:
+            return self.board_aggregate(stop, time)
         # people waiting at bus stop will get on if bus goes to desired destination and there is space on the bus
         n = stop.update(time)
         boarding_time = time
         count = 0
         people_just_arrived = stop.people_waiting[-n:]
-        hour = int(time / 30)
+        hour = time_bin(time, stop.period)
         for person in stop.people_waiting[:]:
             count += 1
             if self.occupancy == self.max_cap:
@@ -339,15 +636,61 @@ class Bus:
                 stop.num_waiting -= 1
                 stop.num_waiting_hr -= 1
                 person.waiting_time = boarding_time - person.start_time  # record waiting time
-                if person.waiting_time > 120:
+                person.board_time = boarding_time
+                if person.waiting_time > self.dead_threshold:
                     self.dead_people += 1
-                person.origin.add_waiting_time(person.destination, person.waiting_time) # update the origin waiting time
-                boarding_time += np.random.triangular(0, 1/60, 5/60)   # boarding times have triangular distribution
+                person.origin.add_waiting_time(person.destination, person.waiting_time, person.start_time) # update the origin waiting time
+                boarding_time += self.variates.boarding.next()        # boarding times have triangular distribution
                 stop.update(boarding_time)  # people arrive while bus is boarding
                 person.state = 'standing'
                 if person in people_just_arrived:
                     stop.avg_num_waiting += person.waiting_time
-                    stop.avg_num_waiting_t[hour] += person.waiting_time
+                    if hour in stop.avg_num_waiting_t:        # unless the hourly stats are not selected
+                        stop.avg_num_waiting_t[hour] += person.waiting_time
+
+        return boarding_time
+
+    def board_aggregate(self, stop, time):
+        """Boarding without Person objects: pops arrival times from the per-destination queues of the stop.
+
+        People board in the same order as in board(), i.e. by update batch, then by destination, then by
+        arrival time, so both modes produce the same statistics.
+        """
+        first = stop.batch + 1
+        n = stop.update(time)
+        if n == 0:
+            first = 0                         # board() treats everybody as just arrived when nobody did
+        last = stop.batch                     # people arriving while boarding wait for the next pass
+        boarding_time = time
+        hour = time_bin(time, stop.period)
+        destinations = [dest for dest in stop.queue_times.keys() if self.goes_to(dest)]
+        while self.occupancy < self.max_cap:
+            # next eligible person in line: earliest batch, ties broken by destination order
+            dest = None
+            for d in destinations:
+                batches = stop.queue_batches[d]
+                if batches and batches[0] <= last and (dest is None or batches[0] < stop.queue_batches[dest][0]):
+                    dest = d
+            if dest is None:
+                break
+            start_time = stop.queue_times[dest].popleft()
+            batch = stop.queue_batches[dest].popleft()
+            self.counts[dest] = self.counts.get(dest, 0) + 1
+            self.occupancy += 1
+            stop.num_waiting -= 1
+            stop.num_waiting_hr -= 1
+            waiting_time = boarding_time - start_time  # record waiting time
+            if waiting_time > self.dead_threshold:
+                self.dead_people += 1
+            stop.add_waiting_time(dest, waiting_time, start_time)
+            if self.journeys is not None:
+                self.riders.append((stop, dest, start_time, boarding_time))
+            boarding_time += self.variates.boarding.next()        # boarding times have triangular distribution
+            stop.update(boarding_time)  # people arrive while bus is boarding
+            if batch >= first:
+                stop.avg_num_waiting += waiting_time
+                if hour in stop.avg_num_waiting_t:            # unless the hourly stats are not selected
+                    stop.avg_num_waiting_t[hour] += waiting_time
 
         return boarding_time
 
@@ -362,14 +705,19 @@ class Bus:
         if not changed:
             self.next_stop_num = self.next_stop_num % (len(self.route.stops) - 1) + 1    # update next stop number
             self.next_stop = self.route.stops[self.next_stop_num]
-        before = len(self.passengers)
-
         # if current stop is destination, passenger will get off
+        if self.aggregate:
+            self.occupancy -= self.counts.pop(stop, 0)
+            if self.journeys is not None:
+                self.log_riders(stop, time)
         for person in self.passengers[:]:
             if person.destination == stop:
                 self.passengers.remove(person)
                 self.occupancy -= 1
                 # TODO: add time taken for people to get off?
+                if self.journeys is not None:
+                    self.journeys.append(person.origin.name, stop.name, self.name, person.state == 'sitting',
+                                         person.start_time, person.board_time, time)
                 person.state = 'arrived'
 
         if debug:
@@ -377,6 +725,18 @@ class Bus:
 
         return Event(time, self, stop, 'departure')
 
+    def log_riders(self, stop, time):
+        """Log the trips of the riders alighting at stop (aggregate mode); the first num_seats riders are seated"""
+        riders = []
+        for k, rider in enumerate(self.riders):
+            origin, dest, start_time, boarding_time = rider
+            if dest == stop:
+                self.journeys.append(origin.name, stop.name, self.name, k < self.num_seats, start_time,
+                                     boarding_time, time)
+            else:
+                riders.append(rider)
+        self.riders = riders
+
     def depart(self, stop, time, earliest_depart):
         """Models a bus driving from one stop to another"""
 
@@ -388,19 +748,20 @@ class Bus:
         if distance_travelled < 2:
             driving_time = (distance_travelled/20) * 60    # average speed of 20km/hr, convert to minutes
         else:
-            driving_time = np.random.uniform(5, 7)       # average speed of 20km/hr, +/-1 min variability
+            driving_time = self.variates.driving.next()  # average speed of 20km/hr, +/-1 min variability
 
         done_boarding = self.board(stop, time)
         if done_boarding < earliest_depart:
             done_boarding = self.board(stop, time)
 
-        # first 25 passengers will sit down (or all, if less than 25 people on bus)
-        for i in range(min(self.occupancy, 25)):
+        # first num_seats passengers will sit down (or all, if fewer people are on the bus)
+        for i in range(min(len(self.passengers), self.num_seats)):
             self.passengers[i].state = 'sitting'
 
         return Event(done_boarding + driving_time, self, self.next_stop, 'arrival')
 
     def add_animation(self, surface, depot):
+        import pygame
         self.animate = True
         self.surface = surface
         self.icon = pygame.image.load('images/bus.png')
@@ -409,15 +770,21 @@ class Bus:
         self.surface.blit(self.icon, self.icon_rect)
 
     def update_animation(self):
+        import pygame
         self.icon_rect.center = (self.next_stop.surface_pos[0] - 55, self.next_stop.surface_pos[1])
         self.surface.blit(self.icon, self.icon_rect)
         pygame.display.flip()
 
     def reset(self):
         """ reset simulation """
+        self.route = self.start_route
+        self.to_change = None
+        self.change_tracker = [0, 0]
         self.next_stop_num = 1
         self.next_stop = self.route.stops[1]
         self.passengers = []
+        self.counts = {}
+        self.riders = []
         self.occupancy = 0
         self.distance = 0
         self.avg_occupancy = 0
@@ -433,6 +800,7 @@ class BusStop:
         name (str): Name of the bus stop.
         num_waiting (int): Number of people currently waiting at this bus stop.
         people_waiting (list): List of person objects representing people waiting at this bus stop
+        queue_times (dict): Destination -> FIFO of arrival times of people waiting (aggregate mode only)
 
         times (dict): Dict of arrival times of people arriving at this bus stop
 
@@ -443,6 +811,14 @@ class BusStop:
         self.num_waiting = 0        # bus stop starts with nobody waiting
         self.num_waiting_hr = 0     # hourly waiting number at bus stop
         self.people_waiting = []    # list of people waiting at this stop; initially empty
+        self.aggregate = False      # if true, keep FIFO arrival times per destination instead of Person objects
+        self.queue_times = {}       # destination -> deque of arrival times (aggregate mode)
+        self.queue_batches = {}     # destination -> deque of update batch numbers (aggregate mode)
+        self.batch = 0              # number of calls to update, orders people arriving in the same call
+        self.horizon = 0            # latest time passed to update: arrivals after it are not observed yet
+        self.window = None          # if set, arrivals are generated lazily this many minutes at a time
+        self.generated = 0          # arrivals are generated until this time (lazy arrivals only)
+        self.period = None          # length of the repeating service day of a windowed run
         self.arrival_rates = {}     # dict of arrival rates (key:destination, value: arrival rate)
         self.times = {}             # dict of arrival times (key:destination, value:list of times)
 
@@ -456,22 +832,68 @@ class BusStop:
         self.num_getoff = {}        # destination(str) -> number of people used this path
 
         self.avg_num_waiting_t = {} # destination(str) -> list of number per hour
+        self.wait_edges = None      # bin edges of the waiting time histograms, set by Map.start
+        self.queue_edges = None     # bin edges of the queue length histogram, set by Map.start
+        self.wait_hist = {}         # destination(str) -> 3-hour block -> number of people per waiting time bin
+        self.queue_hist = []        # 3-hour block -> queue length -> minutes spent at it
 
     def add_data(self, arrival_rates):
         """Record arrival rates to this bus stop as a dict (key: destination, value: arrival rate(s))"""
         self.arrival_rates = arrival_rates
 
-    def generate_data(self, max_time):
-        # TODO: generate with non-constant arrival rate
+    def generate_data(self, max_time, reseed=True, times=None, window=None):
+        """Generate arrival times of people for each destination
+        Args:
+            max_time (float): number of minutes to generate
+            reseed (bool): if true, reseed the random number generator from fresh entropy
+            times (dict): if given, use these arrival times instead (destination name -> sorted times)
+            window (float): if given, only generate arrivals `window` minutes ahead of the clock (see advance)
+        """
+        self.horizon = 0
+        self.window = window if times is None else None
+        self.generated = 0
         for stop in self.arrival_rates.keys():
             lmbda = self.arrival_rates[stop]
-            np.random.seed()
-            if isinstance(lmbda, (list, np.ndarray)):
+            if reseed and times is None:
+                np.random.seed()
+            if self.window is not None:
+                self.times[stop] = []
+            elif times is not None:
+                self.times[stop] = list(times.get(stop.name, []))
+            elif isinstance(lmbda, (list, np.ndarray)):
                 self.times[stop] = list(generate_arrival(lmbda, interval=180))
             elif isinstance(lmbda, (int, float)):
                 self.times[stop] = list(np.cumsum(np.random.exponential(1/lmbda, int(max_time*lmbda))))
             else:
                 raise ValueError('Arrival rates must be specified as a number or list/array.')
+            self.queue_times[stop] = deque()
+            self.queue_batches[stop] = deque()
+
+    def advance(self, time):
+        """Generate the arrivals of the next windows until time is covered (lazy arrivals only)"""
+        while self.generated <= time:
+            for stop, lmbda in self.arrival_rates.items():
+                self.times[stop].extend(self.generate_window(lmbda, self.generated, self.generated + self.window))
+            self.generated += self.window
+
+    @staticmethod
+    def generate_window(lmbda, start, end, rng=np.random):
+        """Arrival times in [start, end) for piecewise rates (# arrival / hour) or a single rate (# arrival / minute)"""
+        if isinstance(lmbda, (int, float)):
+            lmbda = [lmbda * 60]
+        elif not isinstance(lmbda, (list, np.ndarray)):
+            raise ValueError('Arrival rates must be specified as a number or list/array.')
+        return generate_window(lmbda, start, end, interval=180, rng=rng).tolist()
+
+    def resample(self, rng):
+        """Replace the arrivals that are not observed yet (after horizon) by new ones, e.g. in a copy of a run"""
+        for stop, lmbda in self.arrival_rates.items():
+            if self.window is not None:
+                self.times[stop] = self.generate_window(lmbda, self.horizon, self.generated, rng=rng)
+                continue
+            if not isinstance(lmbda, (list, np.ndarray)):
+                raise ValueError('Resampling needs piecewise arrival rates (list/array).')
+            self.times[stop] = list(generate_piecewise(lmbda, start=self.horizon, interval=180, rng=rng))
 
     def add_animation(self, surface, coords):
         """Set animation attributes
@@ -485,6 +907,7 @@ class BusStop:
 
     def update_animation(self):
         """Updates the animation screen to reflect current people waiting at this bus stop"""
+        import pygame
         # remove unused images
         clear = pygame.image.load('images/nobody.png')
         for i in range(self.prev_num_waiting):
@@ -510,28 +933,59 @@ class BusStop:
         self.num_waiting_hr += 1
         self.people_waiting.append(person)
 
-    def add_waiting_time(self, dest, time):
-        """Add waiting time in the dictionary """
+    def add_waiting_time(self, dest, time, start=None):
+        """Add waiting time in the dictionary, and in the histogram of the 3-hour block of the arrival time start"""
         if dest.name in self.waiting_time.keys():
             self.waiting_time[dest.name] += time
             self.num_getoff[dest.name] += 1
         else:
             self.waiting_time[dest.name] = time
             self.num_getoff[dest.name] = 1
+        if self.wait_edges is not None and start is not None:
+            rows = self.wait_hist.setdefault(dest.name, [])
+            k = max(bisect_right(self.wait_edges, time) - 1, 0)     # people boarding as they arrive wait ~0
+            self.histogram_row(rows, start, self.wait_edges)[k] += 1
+
+    def add_queue_time(self, time, duration):
+        """Add the minutes spent from time on at the current queue length in the queue length histogram"""
+        block = int((time if self.period is None else time % self.period) / 180)
+        while len(self.queue_hist) <= block:
+            self.queue_hist.append({})
+        row = self.queue_hist[block]
+        row[self.num_waiting] = row.get(self.num_waiting, 0) + duration     # binned by histograms()
+
+    def histogram_row(self, rows, time, edges):
+        """Row of a histogram for the 3-hour block of time, adding empty rows up to it"""
+        block = time_bin(time, self.period, 180)
+        while len(rows) <= block:
+            rows.append([0] * (len(edges) - 1))
+        return rows[block]
 
     def update(self, time):
         """Updates arrivals to this bus stop until a given time"""
         arrived = 0
+        self.batch += 1
+        if time > self.horizon:
+            self.horizon = time
+        if self.window is not None and time >= self.generated:
+            self.advance(time)
         for destination, arrival_times in self.times.items():
-            for arrival_time in arrival_times[:]:
-                if arrival_time < time:
-                    arrived += 1
+            n = bisect_left(arrival_times, time)    # arrival times are sorted
+            if n == 0:
+                continue
+            if self.aggregate:
+                self.queue_times[destination].extend(arrival_times[:n])
+                self.queue_batches[destination].extend([self.batch] * n)
+                self.num_waiting += n
+                self.num_waiting_hr += n
+            else:
+                for arrival_time in arrival_times[:n]:
                     self.arrival(Person(self, destination, arrival_time))
-                    arrival_times.remove(arrival_time)
-                else:
-                    break
+            del arrival_times[:n]
+            arrived += n
 
         if self.animate:
+            import pygame
             self.update_animation()
             # sleep(0.1)               # controls speed of animation
             pygame.display.flip()      # update display
@@ -542,11 +996,19 @@ class BusStop:
         """Reset map to initial (or newly generated) settings"""
         self.num_waiting = 0
         self.people_waiting = []
+        self.queue_times = {}
+        self.queue_batches = {}
+        self.batch = 0
+        self.horizon = 0
+        self.window = None
+        self.generated = 0
         self.num_waiting_hr = 0
         self.avg_num_waiting = 0
         self.waiting_time = {}
         self.num_getoff = {}
         self.avg_num_waiting_t = {}
+        self.wait_hist = {}
+        self.queue_hist = []
 
 
 class Person:
@@ -559,8 +1021,11 @@ class Person:
         state (str): Describes state of person. One of 'waiting', 'sitting', 'standing', 'arrived'.
         start_time (float): Time at which person arrived at origin bus stop.
         waiting_time (float): Time spent waiting at origin bus stop.
+        board_time (float): Time at which person boarded.
 
     """
+    __slots__ = ('origin', 'destination', 'state', 'start_time', 'waiting_time', 'board_time')
+
     def __init__(self, origin, destination, time):
 
         assert(isinstance(origin, BusStop)), "origin must be a BusStop"
@@ -572,6 +1037,7 @@ class Person:
         self.state = 'waiting'             # status of person, either 'waiting', 'standing' or 'sitting'
         self.start_time = time             # time at which person started waiting
         self.waiting_time = None           # time spent waiting at bus stop
+        self.board_time = None             # time at which person boarded
 
 
 class Route:
@@ -0,0 +1,106 @@
+import copy
+import numpy as np
+from statistics import NormalDist
+from arrival import generate_piecewise
+from experiment import create_map
+from executor import chunks, run_chunked
+from variates import Variates
+
+
+def max_queue(m):
+    """ importance function of the splitting: longest queue over all bus stops """
+    return max(bs.num_waiting for bs in m.bus_stops.values())
+
+
+def branch(m, rng):
+    """ Copy a paused run and give the copy its own future: new variate streams and new unobserved arrivals """
+    clone = copy.deepcopy(m)
+    clone.variates = Variates(rng.randint(2**32), clone.variate_block)
+    for bus in clone.buses:
+        bus.variates = clone.variates
+    for bus_stop in clone.bus_stops.values():
+        bus_stop.resample(rng)
+    return clone
+
+
+def split_run(m, levels, factor, rng, weight=1.0, level=0):
+    """ Continue a run, splitting it into `factor` weighted copies whenever the longest queue crosses a level
+    Returns:
+        (sum of weight * dead people over the leaves of the splitting tree, number of leaves)
+    """
+    paused = not m.run(pause=lambda mm: level < len(levels) and max_queue(mm) >= levels[level])
+    if not paused:
+        m.finish()
+        return weight * m.collect_stats()['total dead people'], 1
+    # copies are made before the original continues, so each one starts from the crossing state
+    runs = [m] + [branch(m, rng) for _ in range(factor - 1)]
+    total, leaves = 0, 0
+    for run in runs:
+        value, n = split_run(run, levels, factor, rng, weight / factor, level + 1)
+        total += value
+        leaves += n
+    return total, leaves
+
+
+def splitting_process(args):
+    """ atomic process of the splitting estimator: root replications start, ..., start + iteration - 1 """
+    m = create_map(**args['spec'])
+    results = []
+    for i in range(args['start'], args['start'] + args['iteration']):
+        rng = np.random.RandomState([args['seed'] + i, 2])
+        # arrivals of exact piecewise poisson processes, the same law as the resampled futures
+        arrivals = {origin: {dest.name: generate_piecewise(rates, rng=rng) for dest, rates in stop.arrival_rates.items()}
+                    for origin, stop in m.bus_stops.items()}
+        m.start(args['max_time'], seed=args['seed'] + i, arrivals=arrivals)
+        results.append(split_run(m, args['levels'], args['factor'], rng))
+        m.reset()
+    return results
+
+
+def estimate_dead_people(model, max_time, iteration, levels=(40, 80, 120, 160), factor=3, seed=0, alpha=0.05,
+                         executor=None):
+    """ Multilevel splitting estimate of the expected number of dead people (waits over 120 minutes)
+
+    People die only after a queue has built up, so each run is split into `factor` copies whenever the
+    longest queue first reaches the next level. Every copy keeps the state at the crossing, gets new
+    variates and new arrivals after it, and carries 1/factor of the weight, so the weighted sum of dead
+    people of each root replication is an unbiased estimate that samples the rare congested runs far more
+    often than plain Monte Carlo (levels=() is plain Monte Carlo).
+
+    Args:
+        model (Map) : map built by create_map with piecewise arrival rates
+        max_time (int) : duration time for each simulation
+        iteration (int) : number of root replications
+        levels (tuple) : increasing queue lengths at which runs are split
+        factor (int) : number of copies at each split
+        seed (int) : root replication i uses seed + i
+        alpha (float) : the confidence interval has level 1 - alpha
+        executor : executor from executor.py; default is a local process pool
+    Returns:
+        dict with 'estimate', 'std error', 'ci' (low, high) and 'runs' (number of simulated paths)
+    """
+    args = [{'spec': model.spec, 'max_time': max_time, 'levels': list(levels), 'factor': factor, 'seed': seed,
+             'start': start, 'iteration': count} for start, count in chunks(iteration)]
+    results = run_chunked(splitting_process, args, executor)
+
+    samples = np.array([r[0] for r in results], dtype=float)
+    estimate = samples.mean()
+    std_error = samples.std(ddof=1) / np.sqrt(len(samples)) if len(samples) > 1 else np.inf
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    return {'estimate': estimate,
+            'std error': std_error,
+            'ci': (estimate - z * std_error, estimate + z * std_error),
+            'runs': sum(r[1] for r in results)}
+
+
+if __name__ == '__main__':
+    b1 = [1, 1, 1, 1, 1, 1]
+    b2 = [1, 2, 2, 2, 3, 1]
+    b3 = [3, 1, 1, 1, 1, 1]
+    b4 = [1, 3, 2, 3, 2, 2]
+    b5 = [2, 2, 1, 2, 1, 1]
+    b6 = [1, 1, 1, 2, 3, 1]
+    b7 = [1, 2, 2, 2, 3, 3]
+
+    model = create_map([b1, b2, b3, b4, b5, b6, b7], name='opt-2hr', aggregate=True)
+    print(estimate_dead_people(model, 60*18, 100))
@@ -0,0 +1,136 @@
+import numpy as np
+from arrival import generate_piecewise
+from experiment import create_map, load_pandas
+from executor import chunks, run_chunked
+
+# outcome name -> function of the stats of one replication (see Map.collect_stats)
+OUTCOMES = {'avg waiting time': lambda stats: np.mean([v for k, v in stats.items() if k.endswith('waiting time total')]),
+            'dead people': lambda stats: stats['total dead people']}
+# stats the outcomes read, the only ones the runs keep (see Map.select)
+OUTCOME_STATS = ['% waiting time total', 'total dead people']
+
+# capacity parameter -> keyword argument of Bus.set_capacity
+CAPACITIES = ('num_seats', 'standing_cap')
+
+
+def rate_scores(arrivals, m, max_time, interval=180):
+    """ Score of the arrivals of a run with respect to the arrival rates, N - Lambda
+
+    With rates multiplied by theta, the log-likelihood of the arrivals of an OD pair in [0, max_time) is
+    sum_k N_k log(theta r_k) - theta r_k t_k, whose derivative at theta=1 is N - Lambda: arrivals minus
+    expected arrivals. Only exact poisson arrivals (generate_piecewise) have this likelihood.
+    Args:
+        arrivals (dict) : origin name -> destination name -> arrival times, as passed to Map.start
+        m (Map) : the map, whose bus stops hold the arrival rates (# arrival / hour) per 3-hour block
+        max_time (int) : duration time of the run
+        interval (int) : number of minutes during which each rate applies
+    Returns:
+        dict of (origin name, destination name) -> array of scores, one per block
+    """
+    scores = {}
+    for origin, stop in m.bus_stops.items():
+        for dest, rates in stop.arrival_rates.items():
+            times = np.asarray(arrivals[origin][dest.name])
+            blocks = np.arange(len(rates))
+            exposure = np.clip(max_time - blocks * interval, 0, interval)       # minutes of each block in the run
+            counts = np.bincount((times[times < max_time] // interval).astype(int), minlength=len(rates))
+            scores[(origin, dest.name)] = counts[:len(rates)] - np.asarray(rates, dtype=float) / 60 * exposure
+    return scores
+
+
+def sensitivity_process(args):
+    """ atomic process of the sensitivity estimates: replications start, ..., start + iteration - 1
+    Every replication is run once at the base parameters, which gives the outcomes and the rate scores, and
+    once per capacity parameter with that capacity changed by step, with the same arrivals and seed.
+    """
+    m = create_map(**args['spec'])
+    m.metrics = OUTCOME_STATS
+    base = {bus.name: (bus.num_seats, bus.standing_cap) for bus in m.buses}
+    results = []
+    for i in range(args['start'], args['start'] + args['iteration']):
+        rng = np.random.RandomState([args['seed'] + i, 3])
+        arrivals = {origin: {dest.name: generate_piecewise(rates, rng=rng) for dest, rates in stop.arrival_rates.items()}
+                    for origin, stop in m.bus_stops.items()}
+        runs = {}
+        for parameter in (None,) + CAPACITIES:
+            for bus in m.buses:
+                bus.set_capacity(*base[bus.name])
+                if parameter is not None:
+                    bus.set_capacity(**{parameter: getattr(bus, parameter) + args['step']})
+            m.simulate(args['max_time'], seed=args['seed'] + i, arrivals=arrivals)
+            stats = m.collect_stats(hourly=False)
+            runs[parameter] = {name: f(stats) for name, f in OUTCOMES.items()}
+            m.reset()
+        results.append((runs, rate_scores(arrivals, m, args['max_time'])))
+    return results
+
+
+def _row(parameter, outcome, samples, method):
+    samples = np.asarray(samples, dtype=float)
+    std_error = samples.std(ddof=1) / np.sqrt(len(samples)) if len(samples) > 1 else np.inf
+    return {'parameter': parameter, 'outcome': outcome, 'value': samples.mean(), 'std error': std_error,
+            'method': method}
+
+
+def sensitivity(model, max_time, iteration, seed=0, step=1, blocks=False, executor=None):
+    """ Derivatives of the expected waiting time and dead people, from the replications of the base estimate
+
+    Arrival rates: score function (likelihood ratio) estimates. A replication with outcome Y and rate
+    score S (see rate_scores) gives (Y - mean Y) S, an unbiased estimate of dE[Y]/d theta when the rates
+    of an OD pair (or all of them, 'demand') are multiplied by theta: the change of the outcome per +100%
+    of the rate, so +10% changes it by about a tenth of the value. No extra run is needed, but the
+    arrivals must be exact poisson processes, so they are drawn with generate_piecewise.
+    Capacities: each replication is run again with num_seats, then standing_cap, increased by step on
+    every bus, with the same arrivals and seed (common random numbers), and the paired difference divided
+    by step estimates the derivative.
+
+    Args:
+        model (Map) : map built by create_map with piecewise arrival rates
+        max_time (int) : duration time for each simulation
+        iteration (int) : number of replications
+        seed (int) : replication i uses seed + i
+        step (int) : change of the capacities in the paired runs
+        blocks (bool) : if true, also estimate the derivatives with respect to the rate of every 3-hour block
+        executor : executor from executor.py; default is a local process pool
+    Returns:
+        DataFrame with one row per parameter and outcome: 'parameter' ('base' for the base estimate,
+        'demand', '<origin>-<destination> rate', '<origin>-<destination> rate block k', 'num_seats' or
+        'standing_cap'), 'outcome', 'value', 'std error' and 'method'
+    """
+    pd = load_pandas()
+    args = [{'spec': model.spec, 'max_time': max_time, 'seed': seed, 'step': step, 'start': start,
+             'iteration': count} for start, count in chunks(iteration)]
+    results = run_chunked(sensitivity_process, args, executor)
+
+    rows = []
+    pairs = list(results[0][1].keys())
+    for outcome in OUTCOMES:
+        y = np.array([runs[None][outcome] for runs, _ in results], dtype=float)
+        rows.append(_row('base', outcome, y, 'mean'))
+        centered = y - y.mean()
+        scores = {'demand': [sum(k.sum() for k in run.values()) for _, run in results]}
+        for origin, dest in pairs:
+            scores[origin + '-' + dest + ' rate'] = [run[(origin, dest)].sum() for _, run in results]
+            if blocks:
+                for k in range(len(results[0][1][(origin, dest)])):
+                    scores['{}-{} rate block {}'.format(origin, dest, k)] = [run[(origin, dest)][k]
+                                                                           for _, run in results]
+        for parameter, s in scores.items():
+            rows.append(_row(parameter, outcome, centered * np.array(s, dtype=float), 'score function'))
+        for parameter in CAPACITIES:
+            paired = [(runs[parameter][outcome] - runs[None][outcome]) / step for runs, _ in results]
+            rows.append(_row(parameter, outcome, paired, 'paired CRN'))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    b1 = [1, 1, 1, 1, 1, 1]
+    b2 = [2, 2, 1, 1, 3, 1]
+    b3 = [2, 1, 1, 1, 2, 3]
+    b4 = [1, 2, 2, 1, 1, 1]
+    b5 = [3, 3, 2, 2, 3, 2]
+    b6 = [1, 1, 2, 3, 2, 1]
+    b7 = [1, 2, 2, 1, 1, 1]
+
+    model = create_map([b1, b2, b3, b4, b5, b6, b7], aggregate=True, demand=0.5)
+    print(sensitivity(model, 60*18, 100))
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import socketserver
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from urllib.parse import urlparse, parse_qs
+from arrival import load_rates
+from experiment import create_map
+from pySimio import load_pandas
+from store import Store
+from symmetry import canonical, canonical_hash
+
+# stats returned by the service, computed from the stats of each replication
+ANSWERS = ('avg waiting time', 'dead people')
+
+# templates of the worker processes: demand -> map, built once and reused by every replication
+_templates = {}
+_rates = None
+
+
+def _warm(arrival_data, demands):
+    """ initializer of the worker processes: load the arrival rates and build the map templates """
+    global _rates
+    sys.stdout = open(os.devnull, 'w')     # Map.simulate reports every replication
+    _rates = load_rates(arrival_data) if isinstance(arrival_data, str) else arrival_data
+    for demand in demands:
+        _template(demand)
+
+
+def _template(demand):
+    if demand not in _templates:
+        _templates[demand] = create_map([[1] * 6] * 7, arrival_data=_rates, aggregate=True, demand=demand)
+    return _templates[demand]
+
+
+def _replicate(task):
+    """ One replication of a schedule on the template of its demand
+    Args:
+        task (tuple) : (routes_per_bus, demand, horizon, seed)
+    Returns:
+        (seed, stats of Map.collect_stats without the 30-minute series)
+    """
+    routes_per_bus, demand, horizon, seed = task
+    m = _template(demand)
+    for bus, routes in zip(m.buses, routes_per_bus):
+        bus.schedule = list(routes)
+        bus.start_route = m.routes[routes[0] - 1]
+    m.reset()
+    m.simulate(horizon, seed=seed)
+    stats = m.collect_stats(hourly=False)
+    m.reset()
+    return seed, stats
+
+
+def _summary(df):
+    """ mean and standard error over the replications of the answered stats """
+    waits = df[[k for k in df.keys() if k.endswith('waiting time total')]].mean(axis=1)
+    values = {'avg waiting time': waits.values, 'dead people': df['total dead people'].values}
+    out = {'replications': len(df)}
+    for name in ANSWERS:
+        v = values[name].astype(float)
+        out[name] = float(v.mean()) if len(v) else None
+        out[name + ' std error'] = float(v.std(ddof=1) / np.sqrt(len(v))) if len(v) > 1 else None
+    return out
+
+
+class WhatIf:
+    """ Answers what-if questions on fleet schedules from the results store, simulating what is missing
+
+    A question is a schedule of the 7 buses and a demand level (multiplier of the arrival rates). The
+    answer is the mean and standard error over the replications of the average waiting time and of the
+    number of people who waited more than 120 minutes. Replications use seeds 0, 1, ... of the canonical
+    schedule (see symmetry.py), so equivalent schedules share their answers, and every replication is
+    added to the results store. A schedule with fewer than `quick` stored replications gets them from
+    the warm worker processes, in parallel, before the answer; the replications up to `target` then run
+    in the background, and asking again returns the refined answer.
+
+    Args:
+        store (Store) : results store answered from and filled
+        arrival_data (str) : excel file of arrival rates
+        horizon (int) : duration time of each simulation
+        quick (int) : replications of the first answer
+        target (int) : replications of the refined answer
+        processes (int) : number of warm worker processes
+        demands (tuple) : demand levels whose map templates are built when the workers start
+    """
+    def __init__(self, store, arrival_data='data/ArrivalRates.xlsx', horizon=60*18, quick=4, target=30,
+                 processes=None, demands=(1.0,)):
+        self.store = store
+        self.arrival_data = arrival_data
+        self.rates = load_rates(arrival_data) if isinstance(arrival_data, str) else arrival_data
+        self.horizon = horizon
+        self.quick = quick
+        self.target = target
+        self.lock = threading.Lock()        # the store is shared by the request and result threads
+        self.pending = {}                   # (schedule hash, demand) -> number of background replications left
+        self.pool = Pool(processes or os.cpu_count(), initializer=_warm, initargs=(self.rates, demands))
+
+    def scenario(self, demand):
+        """ scenario name of the store, the same as for experiments with maps built by create_map """
+        return '{} x{:g}'.format(os.path.basename(self.arrival_data) if isinstance(self.arrival_data, str)
+                                 else 'rates', demand)
+
+    def stored(self, routes, demand):
+        """ stored replications of a canonical schedule, one row per seed """
+        with self.lock:
+            return self.store.metrics(['% waiting time total', 'total dead people'], schedule=routes,
+                                      scenario=self.scenario(demand), horizon=self.horizon,
+                                      version=self.store.version)
+
+    def ingest(self, routes, demand, results):
+        """ add replications (seed, stats) of a canonical schedule to the store """
+        pd = load_pandas()
+        m = create_map(routes, arrival_data=self.rates, name='whatif', aggregate=True, demand=demand)
+        with self.lock:
+            for seed, stats in results:
+                row = dict(stats, model='whatif', iteration=0)
+                self.store.ingest(pd.DataFrame([row]), [m], self.horizon, seed=seed, scenario=self.scenario(demand))
+
+    def ask(self, routes_per_bus, demand=1.0):
+        """ Answer a question
+        Args:
+            routes_per_bus (list) : route schedule of each bus
+            demand (float) : multiplier applied to every arrival rate
+        Returns:
+            dict with the canonical schedule, the answered stats and their standard errors, the number of
+            replications, 'source' ('store' or 'estimate' if some were simulated for this answer) and
+            'refining' (whether more replications are running in the background)
+        """
+        routes = canonical(routes_per_bus)
+        key = (canonical_hash(routes), demand)
+        runs = self.stored(routes, demand)
+        seeds = set(int(s) for s in runs['seed']) if len(runs) else set()
+        source = 'store'
+        missing = [s for s in range(self.quick) if s not in seeds]
+        if len(runs) < self.quick and missing:
+            results = self.pool.map(_replicate, [(routes, demand, self.horizon, s) for s in missing])
+            self.ingest(routes, demand, results)
+            runs = self.stored(routes, demand)
+            seeds |= set(missing)
+            source = 'estimate'
+        self.refine(routes, demand, key, [s for s in range(self.target) if s not in seeds])
+        answer = {'schedule': routes, 'demand': demand, 'horizon': self.horizon, 'source': source}
+        answer.update(_summary(runs))
+        with self.lock:
+            answer['refining'] = key in self.pending
+        return answer
+
+    def refine(self, routes, demand, key, seeds):
+        """ run the replications of seeds in the background, unless they are already running """
+        with self.lock:
+            if not seeds or key in self.pending:
+                return
+            self.pending[key] = len(seeds)
+
+        def done(result):
+            try:
+                self.ingest(routes, demand, [result])
+            except Exception as error:      # runs on the result thread of the pool, which must not die
+                failed(error)
+                return
+            with self.lock:
+                if key in self.pending:         # not after a failure
+                    self.pending[key] -= 1
+                    if self.pending[key] == 0:
+                        del self.pending[key]
+
+        def failed(error):
+            with self.lock:
+                self.pending.pop(key, None)
+            print('refinement failed:', error)
+
+        for seed in seeds:
+            self.pool.apply_async(_replicate, ((routes, demand, self.horizon, seed),), callback=done,
+                                  error_callback=failed)
+
+    def close(self):
+        self.pool.terminate()
+
+
+def parse_question(query):
+    """ schedule and demand of a question, from the query string or the JSON body of a request """
+    routes = query['schedule']
+    routes = json.loads(routes) if isinstance(routes, str) else routes
+    if (not isinstance(routes, list) or len(routes) != 7 or
+            any(not isinstance(r, list) or len(r) != len(routes[0]) or not r for r in routes) or
+            any(x not in (1, 2, 3) for r in routes for x in r)):
+        raise ValueError('schedule must be 7 lists of the same length of routes 1, 2 or 3')
+    demand = float(query.get('demand', 1.0))
+    if demand <= 0:
+        raise ValueError('demand must be positive')
+    return routes, demand
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ GET /whatif?schedule=[[1,1,1,1,1,1],...]&demand=1.2, POST /whatif with a JSON body, GET /health """
+    whatif = None       # WhatIf answering the questions, set by serve
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def answer(self, query):
+        try:
+            routes, demand = parse_question(query)
+        except (KeyError, ValueError, TypeError) as e:
+            return self.reply(400, {'error': str(e) or 'missing schedule'})
+        self.reply(200, self.whatif.ask(routes, demand))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self.reply(200, {'status': 'ok'})
+        if url.path != '/whatif':
+            return self.reply(404, {'error': 'unknown path'})
+        self.answer({k: v[0] for k, v in parse_qs(url.query).items()})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/whatif':
+            return self.reply(404, {'error': 'unknown path'})
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            return self.reply(400, {'error': 'body must be JSON'})
+        self.answer(query)
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(whatif, host='127.0.0.1', port=8765, socket_path=None):
+    """ Serve the questions over HTTP on localhost, or on a Unix socket if socket_path is given """
+    Handler.whatif = whatif
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        whatif.close()
+
+
+if __name__ == '__main__':
+    # python service.py [port | unix:<socket path>]
+    where = sys.argv[1] if len(sys.argv) > 1 else '8765'
+    whatif = WhatIf(Store())
+    if where.startswith('unix:'):
+        serve(whatif, socket_path=where[5:])
+    else:
+        serve(whatif, port=int(where))
@@ -0,0 +1,111 @@
+import queue
+import asyncio
+from time import time as tf
+
+
+class Subscription:
+    """ Bounded queue of snapshots for one consumer; when full the oldest snapshot is dropped
+
+    Attributes:
+        queue (queue.Queue): snapshots waiting to be read
+        dropped (int): number of snapshots dropped because the consumer was too slow
+    """
+    def __init__(self, maxsize=16):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, snapshot):
+        """ put a snapshot without ever blocking the simulation """
+        while True:
+            try:
+                self.queue.put_nowait(snapshot)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """ block until the next snapshot is available """
+        return self.queue.get(timeout=timeout)
+
+
+class AsyncSubscription(Subscription):
+    """ Subscription read from an asyncio event loop, e.g. while the simulation runs in an executor thread
+
+    Attributes:
+        queue (asyncio.Queue): snapshots waiting to be read with `await subscription.get()`
+    """
+    def __init__(self, loop, maxsize=16):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, snapshot):
+        # asyncio queues are not thread-safe: hand the snapshot over to the loop
+        self.loop.call_soon_threadsafe(self._offer, snapshot)
+
+    def _offer(self, snapshot):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(snapshot)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class SnapshotPublisher:
+    """ Publishes rate-limited snapshots of a running simulation to its subscribers
+
+    Pass the publisher to Map.simulate. A snapshot (see Map.snapshot) is taken at most once every `interval`
+    simulated minutes and at most once every `wall_interval` seconds of real time, plus a final snapshot
+    with `'done': True`. Publishing never blocks: slow subscribers lose their oldest snapshots.
+
+    Args:
+        interval (float) : minimum number of simulated minutes between snapshots
+        wall_interval (float) : minimum number of real seconds between snapshots
+    """
+    def __init__(self, interval=5, wall_interval=0.1):
+        self.interval = interval
+        self.wall_interval = wall_interval
+        self.subscribers = []
+        self.next_time = 0
+        self.next_wall = 0
+
+    def subscribe(self, maxsize=16):
+        """ add a thread-safe subscriber """
+        subscription = Subscription(maxsize)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def subscribe_async(self, loop=None, maxsize=16):
+        """ add a subscriber read from an asyncio event loop (the running loop by default) """
+        subscription = AsyncSubscription(loop or asyncio.get_event_loop(), maxsize)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.remove(subscription)
+
+    def reset(self):
+        """ called at the start of each simulation """
+        self.next_time = 0
+        self.next_wall = 0
+
+    def publish(self, m, time, done=False):
+        """ send a snapshot of map m to every subscriber if the rate limits allow it """
+        if not done:
+            if time < self.next_time or not self.subscribers:
+                return
+            now = tf()
+            if now < self.next_wall:
+                return
+            self.next_wall = now + self.wall_interval
+        self.next_time = time + self.interval
+        snapshot = m.snapshot(time)
+        snapshot['done'] = done
+        for subscription in self.subscribers:
+            subscription.offer(snapshot)
@@ -0,0 +1,267 @@
+import os
+import json
+import sqlite3
+import hashlib
+import numpy as np
+from time import time as tf
+from histogram import WAIT_EDGES, QUEUE_EDGES
+from pySimio import load_pandas
+
+# simulation sources: results of runs are comparable when these files are the same
+_SOURCES = ('pySimio.py', 'arrival.py', 'variates.py', 'experiment.py')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    schedule_hash TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    horizon REAL NOT NULL,
+    seed INTEGER,
+    iteration INTEGER NOT NULL,
+    code_version TEXT NOT NULL,
+    model TEXT,
+    ingested REAL NOT NULL,
+    UNIQUE (schedule_hash, scenario, horizon, seed, code_version)
+);
+CREATE INDEX IF NOT EXISTS runs_scenario ON runs (scenario, horizon);
+CREATE INDEX IF NOT EXISTS runs_version ON runs (code_version);
+CREATE TABLE IF NOT EXISTS schedules (hash TEXT PRIMARY KEY, routes_per_bus TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS metrics (
+    run INTEGER NOT NULL, name INTEGER NOT NULL, value REAL,
+    PRIMARY KEY (run, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS series (
+    run INTEGER NOT NULL, name INTEGER NOT NULL, bins BLOB,
+    PRIMARY KEY (run, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS histograms (
+    run INTEGER NOT NULL, name INTEGER NOT NULL, blocks INTEGER NOT NULL, edges BLOB, counts BLOB,
+    PRIMARY KEY (run, name)
+) WITHOUT ROWID;
+'''
+
+
+def schedule_hash(routes_per_bus):
+    """ short hash of the route schedule of each bus """
+    routes = [[int(r) for r in routes] for routes in routes_per_bus]
+    return hashlib.sha1(json.dumps(routes).encode()).hexdigest()[:16]
+
+
+def code_version(directory=None):
+    """ short hash of the simulation sources, so that runs of modified code are told apart """
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in _SOURCES:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def scenario_name(m):
+    """ demand scenario of a map built by create_map: arrival data and demand multiplier """
+    spec = getattr(m, 'spec', None)
+    if spec is None:
+        return 'unknown'
+    data = spec['arrival_data']
+    if isinstance(data, str):
+        data = os.path.basename(data)
+    else:
+        digest = hashlib.sha1()
+        for k in sorted(data):
+            digest.update(k.encode() + np.asarray(data[k], dtype=float).tobytes())
+        data = 'rates-' + digest.hexdigest()[:8]
+    return '{} x{:g}'.format(data, spec['demand'])
+
+
+class Store:
+    """ Local results store indexed by schedule, demand scenario, horizon, seed and code version
+
+    Runs are kept in an SQLite file: one row per replication in `runs`, and its metrics, 30-minute series
+    and histograms (see experiment(histograms=True)) in tables keyed by (run, name), so a query reads the runs
+    it selects and nothing else. A replication is identified by (schedule hash, scenario, horizon, seed, code
+    version); ingesting it again only adds the stats it did not hold yet (e.g. all the stats of a run first
+    ingested with experiment(metrics=...)), so experiments can be ingested incrementally. Runs without a seed
+    are not reproducible and always added; pruned runs only hold partial statistics and are left out.
+
+    Args:
+        path (str) : SQLite file, created if needed
+    """
+    def __init__(self, path='results/results.db'):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)   # threads serialize their use (see service.py)
+        self.conn.executescript(_SCHEMA)
+        self.names = dict(self.conn.execute('SELECT name, id FROM names'))
+        self.version = code_version()
+
+    def name_id(self, name):
+        if name not in self.names:
+            cursor = self.conn.execute('INSERT INTO names (name) VALUES (?)', (name,))
+            self.names[name] = cursor.lastrowid
+        return self.names[name]
+
+    def ingest(self, df, models, max_time, seed=None, scenario=None, window=None, positions=None):
+        """ Add the replications returned by experiment
+        Args:
+            df (DataFrame) : stats returned by experiment, with columns 'model' and 'iteration'
+            models (list) : the maps of the experiment
+            max_time (int) : duration time of each simulation
+            seed (int) : seed of the experiment; replication i used seed + i
+            scenario (str) : name of the demand scenario; default is derived from the arrival data and demand
+            window (float) : lazy arrival window of the experiment, which makes a different scenario
+            positions (list) : index in models of the model of each row of df; default finds the model by the
+                name in the 'model' column, which needs models with distinct names
+        Returns:
+            number of replications added
+        """
+        if positions is None:
+            names = [m.name for m in models]
+            if len(set(names)) < len(names):
+                raise ValueError('models with the same name: pass the position of the model of each row')
+            positions = [names.index(name) for name in df['model']]
+        suffix = '' if window is None else ' window {:g}'.format(window)
+        scenarios = [(scenario or scenario_name(m)) + suffix for m in models]
+        added = 0
+        with self.conn:
+            for m in models:
+                routes = [bus.schedule for bus in m.buses]
+                self.conn.execute('INSERT OR IGNORE INTO schedules VALUES (?, ?)',
+                                  (schedule_hash(routes), json.dumps([[int(r) for r in rs] for rs in routes])))
+            for position, row in zip(positions, df.to_dict('records')):
+                if row.get('pruned'):
+                    continue                    # partial statistics of a run stopped early
+                row.pop('pruned', None)
+                row.pop('end time', None)
+                row.pop('model')
+                m = models[position]
+                i = int(row.pop('iteration'))
+                key = (schedule_hash([bus.schedule for bus in m.buses]), scenarios[position], max_time,
+                       None if seed is None else seed + i)
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO runs (schedule_hash, scenario, horizon, seed, iteration, code_version, '
+                    'model, ingested) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + (i, self.version, m.name, tf()))
+                if cursor.rowcount == 1:
+                    run = cursor.lastrowid
+                    added += 1
+                else:                           # already stored: add the stats it does not hold yet
+                    run, = self.conn.execute(
+                        'SELECT id FROM runs WHERE schedule_hash = ? AND scenario = ? AND horizon = ? AND seed = ? '
+                        'AND code_version = ?', key + (self.version,)).fetchone()
+                metrics, series, hists = [], [], []
+                for key, value in row.items():
+                    if isinstance(value, np.ndarray) and value.ndim == 2:     # 3-hour block x bin histogram
+                        if key.endswith('waiting time histogram'):
+                            edges = WAIT_EDGES if m.wait_edges is None else m.wait_edges
+                        else:
+                            edges = QUEUE_EDGES if m.queue_edges is None else m.queue_edges
+                        hists.append((run, self.name_id(key), value.shape[0], np.asarray(edges, dtype=float).tobytes(),
+                                      value.astype(float).tobytes()))
+                    elif isinstance(value, str):  # 30-minute series formatted by collect_stats
+                        series.append((run, self.name_id(key), np.array(value.split(), dtype=float).tobytes()))
+                    elif isinstance(value, np.ndarray):
+                        series.append((run, self.name_id(key), value.astype(float).tobytes()))
+                    elif value is not None and not (isinstance(value, float) and np.isnan(value)):
+                        metrics.append((run, self.name_id(key), float(value)))
+                self.conn.executemany('INSERT OR IGNORE INTO metrics VALUES (?, ?, ?)', metrics)
+                self.conn.executemany('INSERT OR IGNORE INTO series VALUES (?, ?, ?)', series)
+                self.conn.executemany('INSERT OR IGNORE INTO histograms VALUES (?, ?, ?, ?, ?)', hists)
+        return added
+
+    def _select(self, schedule=None, scenario=None, horizon=None, seed=None, version=None):
+        """ WHERE clause and parameters selecting runs; schedule is a routes_per_bus list or a schedule hash """
+        clauses, params = [], []
+        if schedule is not None:
+            clauses.append('r.schedule_hash = ?')
+            params.append(schedule if isinstance(schedule, str) else schedule_hash(schedule))
+        for column, value in (('r.scenario', scenario), ('r.horizon', horizon), ('r.seed', seed),
+                              ('r.code_version', version)):
+            if value is not None:
+                clauses.append(column + ' = ?')
+                params.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def runs(self, **where):
+        """ DataFrame of the runs matching schedule, scenario, horizon, seed and version (see metrics) """
+        pd = load_pandas()
+        clause, params = self._select(**where)
+        return pd.read_sql_query('SELECT r.* FROM runs r' + clause + ' ORDER BY r.id', self.conn, params=params)
+
+    def metrics(self, names, **where):
+        """ Metrics of the runs matching the filters, one row per run
+        Args:
+            names (str or list) : metric names, e.g. 'total dead people'; a name containing % is an SQL
+                LIKE pattern (case insensitive), e.g. '% waiting time total'
+            schedule (list or str) : routes_per_bus or schedule hash
+            scenario (str) : demand scenario, e.g. 'ArrivalRates.xlsx x1'
+            horizon (float) : duration time of the runs
+            seed (int) : seed of the replication
+            version (str) : code version (see code_version)
+        Returns:
+            DataFrame with the run columns followed by one column per metric
+        """
+        pd = load_pandas()
+        names = [names] if isinstance(names, str) else list(names)
+        ids = []
+        for n in names:
+            query = 'SELECT id FROM names WHERE name LIKE ?' if '%' in n else 'SELECT id FROM names WHERE name = ?'
+            ids += [i for (i,) in self.conn.execute(query, (n,)) if i not in ids]
+        clause, params = self._select(**where)
+        runs = pd.read_sql_query('SELECT r.* FROM runs r' + clause + ' ORDER BY r.id', self.conn, params=params)
+        if not ids or runs.empty:
+            return runs
+        values = pd.read_sql_query(
+            'SELECT m.run, n.name, m.value FROM runs r JOIN metrics m ON m.run = r.id JOIN names n ON n.id = m.name'
+            + (clause + ' AND' if clause else ' WHERE') + ' m.name IN ({})'.format(','.join('?' * len(ids))),
+            self.conn, params=params + ids)
+        wide = values.pivot(index='run', columns='name', values='value')
+        return runs.join(wide, on='id')
+
+    def series(self, name, **where):
+        """ 30-minute series of one stat for the runs matching the filters (see metrics)
+        Returns:
+            DataFrame with the run columns and a column `name` holding one array per run
+        """
+        pd = load_pandas()
+        clause, params = self._select(**where)
+        rows = self.conn.execute(
+            'SELECT r.id, s.bins FROM runs r JOIN series s ON s.run = r.id' + (clause + ' AND' if clause else ' WHERE')
+            + ' s.name = ?', params + [self.names.get(name, -1)]).fetchall()
+        runs = pd.read_sql_query('SELECT r.* FROM runs r' + clause + ' ORDER BY r.id', self.conn, params=params)
+        bins = {run: np.frombuffer(blob, dtype=float) for run, blob in rows}
+        runs[name] = [bins.get(run) for run in runs['id']]
+        return runs
+
+    def histograms(self, name, **where):
+        """ Histogram of one stat for the runs matching the filters (see metrics), e.g. a waiting time
+        histogram to count the people above a threshold afterwards (see histogram.py)
+        Returns:
+            DataFrame with the run columns, a column `name` holding one 3-hour block x bin array per run and
+            a column 'edges' with its bin edges
+        """
+        pd = load_pandas()
+        clause, params = self._select(**where)
+        rows = self.conn.execute(
+            'SELECT r.id, h.blocks, h.edges, h.counts FROM runs r JOIN histograms h ON h.run = r.id'
+            + (clause + ' AND' if clause else ' WHERE') + ' h.name = ?', params + [self.names.get(name, -1)]).fetchall()
+        runs = pd.read_sql_query('SELECT r.* FROM runs r' + clause + ' ORDER BY r.id', self.conn, params=params)
+        hists = {run: (np.frombuffer(edges, dtype=float), np.frombuffer(counts, dtype=float).reshape(blocks, -1))
+                 for run, blocks, edges, counts in rows}
+        runs[name] = [hists[run][1] if run in hists else None for run in runs['id']]
+        runs['edges'] = [hists[run][0] if run in hists else None for run in runs['id']]
+        return runs
+
+    def schedule(self, hash):
+        """ routes_per_bus of a schedule hash """
+        row = self.conn.execute('SELECT routes_per_bus FROM schedules WHERE hash = ?', (hash,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    store = Store()
+    print(store.runs().groupby(['schedule_hash', 'scenario', 'horizon', 'code_version']).size())
+    store.close()
@@ -0,0 +1,98 @@
+import numpy as np
+from arrival import generate_thinned
+from experiment import create_map, load_pandas
+from executor import chunks, run_chunked
+
+
+def shared_arrivals(maps, rng, interval=180):
+    """ Generate one replication of arrivals for several demand scenarios from shared streams
+    Args:
+        maps (list) : one map per scenario; maps must have the same bus stops (by name)
+        rng : random number generator used for the shared streams
+        interval (int) : number of minutes during which each arrival rate applies
+    Returns:
+        list of arrivals (origin name -> destination name -> times), one per map, for Map.simulate
+    """
+    arrivals = [{} for _ in maps]
+    for origin in maps[0].bus_stops.keys():
+        # OD pairs of every scenario, in the order of the first one
+        rate_sets = {}
+        for k, m in enumerate(maps):
+            for dest, rates in m.bus_stops[origin].arrival_rates.items():
+                if not isinstance(rates, (list, np.ndarray)):
+                    raise ValueError('Shared arrival streams need piecewise arrival rates (list/array).')
+                rate_sets.setdefault(dest.name, [[0]] * len(maps))[k] = rates
+        for dest, rate_set in rate_sets.items():
+            for k, times in enumerate(generate_thinned(rate_set, interval=interval, rng=rng)):
+                arrivals[k].setdefault(origin, {})[dest] = times
+    return arrivals
+
+
+def sweep_process(args):
+    """ atomic process of a sweep: replications start, ..., start + iteration - 1 of the whole grid """
+    schedules = args['schedules']
+    scenarios = args['scenarios']
+    seed = args['seed']
+    # one map per (schedule, scenario), reset after every run
+    maps = {(sch, scn): create_map(routes, name=sch, aggregate=args['aggregate'], **scenarios[scn])
+            for sch, routes in schedules.items() for scn in scenarios}
+    first = next(iter(schedules))
+
+    results = []
+    for i in range(args['start'], args['start'] + args['iteration']):
+        # arrivals of every scenario are generated once per replication and reused by every schedule
+        rng = np.random.RandomState([seed + i, 1])
+        streams = dict(zip(scenarios, shared_arrivals([maps[(first, scn)] for scn in scenarios], rng)))
+        for sch in schedules:
+            for scn in scenarios:
+                m = maps[(sch, scn)]
+                for horizon in args['horizons']:
+                    m.simulate(horizon, seed=seed + i, arrivals=streams[scn])
+                    stats = m.collect_stats()
+                    m.reset()
+                    stats.update({'schedule': sch, 'scenario': scn, 'horizon': horizon, 'iteration': i})
+                    results.append(stats)
+    return results
+
+
+def sweep(schedules, scenarios, horizons, iteration, seed=0, executor=None, chunk=None, aggregate=False,
+          output=None):
+    """ Run every (schedule, demand scenario, horizon) combination under common random numbers
+    Args:
+        schedules (dict) : name -> routes_per_bus, as passed to create_map
+        scenarios (dict) : name -> demand multiplier, or name -> dict of create_map arguments
+            (e.g. {'arrival_data': 'data/Test.xlsx', 'demand': 1.2})
+        horizons (list) : simulation lengths in minutes
+        iteration (int) : number of replications of each combination
+        seed (int) : replication i uses seed + i for the arrival streams and the other random variates
+        executor : executor from executor.py; default is a local process pool
+        chunk (int) : number of replications per task; default splits the replications over the CPUs
+        aggregate (bool) : if true, simulate passengers as counts instead of Person objects
+        output (str) : if given, file name of a csv report written in reports/
+    Returns:
+        DataFrame of stats with the grid coordinates in columns 'schedule', 'scenario', 'horizon', 'iteration'
+    """
+    scenarios = {name: scn if isinstance(scn, dict) else {'demand': scn} for name, scn in scenarios.items()}
+    args = [{'schedules': schedules, 'scenarios': scenarios, 'horizons': list(horizons), 'seed': seed,
+             'start': start, 'iteration': count, 'aggregate': aggregate} for start, count in chunks(iteration, chunk)]
+    stats = run_chunked(sweep_process, args, executor)
+
+    pd = load_pandas()
+    df = pd.DataFrame(stats)
+    if output is not None:
+        df.to_csv('reports/' + output, index=False)
+    return df
+
+
+if __name__ == '__main__':
+    route1 = [1, 1, 1, 1, 1, 1]
+    route2 = [2, 2, 2, 2, 2, 2]
+    route3 = [3, 3, 3, 3, 3, 3]
+
+    schedules = {'700': [route1] * 7,
+                 '511': [route1] * 5 + [route2, route3],
+                 '322': [route1] * 3 + [route2] * 2 + [route3] * 2}
+    scenarios = {'x0.8': 0.8, 'x1.0': 1.0, 'x1.2': 1.2}
+
+    df = sweep(schedules, scenarios, [60*18], 10)
+    print(df.groupby(['schedule', 'scenario'])['total dead people'].mean())
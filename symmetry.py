@@ -0,0 +1,40 @@
+from store import schedule_hash
+
+
+def depot_departure(route):
+    """ Time at which a bus whose schedule starts on route (1, 2 or 3) leaves the depot, as in Map.start:
+    buses starting on route 2 first drive route 1 from the depot, so they leave with those of route 1 """
+    return 1 if int(route) in (1, 2) else 0
+
+
+def canonical(routes_per_bus):
+    """ Canonical form of a fleet schedule: equivalent schedules have the same canonical form
+
+    The simulation processes simultaneous events in the order of the buses, so the order of the buses that
+    leave the depot at the same time matters: they drive together to the first stops, where the first one
+    boards the people waiting. Buses that leave at different times never have simultaneous events, so
+    moving a bus past buses of the other departure time gives exactly the same run (same stats, up to the
+    bus names, for every seed). The canonical form keeps the order of the buses within each departure
+    time, with the buses leaving at t=1 (routes 1 and 2) first, followed by those leaving at t=0 (route 3).
+    Args:
+        routes_per_bus (list) : route schedule of each bus, e.g. [[1, 1, 1, 1, 1, 1], ...]
+    Returns:
+        list of route schedules (lists of int)
+    """
+    order = sorted(range(len(routes_per_bus)), key=lambda i: (-depot_departure(routes_per_bus[i][0]), i))
+    return [[int(r) for r in routes_per_bus[i]] for i in order]
+
+
+def canonical_key(routes_per_bus):
+    """ hashable canonical form, e.g. for a dict of evaluated schedules """
+    return tuple(tuple(routes) for routes in canonical(routes_per_bus))
+
+
+def canonical_hash(routes_per_bus):
+    """ store.schedule_hash of the canonical form, shared by all the equivalent schedules """
+    return schedule_hash(canonical(routes_per_bus))
+
+
+def equivalent(a, b):
+    """ whether two fleet schedules give the same runs """
+    return canonical_key(a) == canonical_key(b)
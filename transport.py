@@ -0,0 +1,152 @@
+import numpy as np
+from pySimio import selection, selected, load_pandas
+from multiprocessing import shared_memory, resource_tracker
+
+
+def layout(m, max_time, window=None, monitored=False, metrics=None):
+    """ Names of the stats that collect_stats and hourly_stats can report for runs of a map
+    Args:
+        m (Map) : the map
+        max_time (int) : duration time for each simulation
+        window (float) : lazy arrival window of the runs (see Map.simulate)
+        monitored (bool) : whether the runs have a monitor, which adds 'pruned' and 'end time'
+        metrics (list) : if given, only the stats selected by these names (see Map.select)
+    Returns:
+        (scalar metric names, 30-minute series names, number of 30-minute bins)
+    """
+    stops = list(m.bus_stops.keys())
+    pairs = [(origin, dest) for origin in stops for dest in stops if origin != dest]
+    names = [origin + "-" + dest + " avg occupancy" for origin, dest in pairs]
+    for bus in m.buses:
+        names += [bus.name + " distance", bus.name + " avg occupancy", bus.name + " avg standing"]
+    for stop in stops:
+        names += [stop + " avg people waiting"] + [stop + "-" + dest + " waiting time" for dest in stops
+                                                   if dest != stop] + [stop + " waiting time total"]
+    names += ['total distance', 'total dead people']
+    series = ([origin + "-" + dest + " hourly occupancy" for origin, dest in pairs] +
+              [bus.name + " hourly occupancy" for bus in m.buses] +
+              [stop + " hourly people waiting" for stop in stops])
+    patterns = selection(metrics)
+    names = [name for name in names if selected(name, patterns)] + ['iteration']
+    series = [name for name in series if selected(name, patterns)]
+    if monitored:
+        names += ['pruned', 'end time']
+    if window is None:
+        bins = int(max_time / 30)           # hourly_stats leaves out the bin past the end of the run
+    else:
+        bins = int(min(max_time, 180 * max(len(bus.schedule) for bus in m.buses)) / 30)
+    return names, series, bins
+
+
+class _Buffer:
+    """ Exposes a shared memory block to numpy and keeps the block open as long as an array uses it """
+    def __init__(self, shm, shape):
+        data = np.frombuffer(shm.buf, dtype=np.float64, count=int(np.prod(shape)))
+        self.__array_interface__ = {'shape': shape, 'typestr': '<f8', 'data': (data.ctypes.data, False),
+                                    'version': 3}
+        del data                # the block stays mapped through shm, without holding an export of its buffer
+        self.shm = shm
+
+
+class SharedResults:
+    """ Results of an experiment in a preallocated shared memory block, filled in place by the workers
+
+    Every row is one replication, laid out as its scalar metrics followed by a block of its 30-minute
+    series (series x bins). Stats that a run does not produce stay nan. The parent creates the block,
+    sends the compact description returned by `spec` to the workers, which attach to the block by name
+    and write their rows, and then wraps the block without copying it. Workers must run on this machine.
+
+    Args:
+        metrics (list) : names of the scalar metrics
+        series (list) : names of the 30-minute series
+        bins (int) : number of 30-minute bins of each series
+        rows (int) : number of replications
+        name (str) : name of an existing block to attach to; default creates a new block
+    """
+    def __init__(self, metrics, series, bins, rows, name=None):
+        self.metrics = list(metrics)
+        self.series_names = list(series)
+        self.bins = bins
+        self.rows = rows
+        width = len(self.metrics) + len(self.series_names) * bins
+        self.shm = self._open(name, max(8, 8 * rows * width))
+        self.array = np.asarray(_Buffer(self.shm, (rows, width)))
+        if name is None:
+            self.array.fill(np.nan)
+        self.values = self.array[:, :len(self.metrics)]                                          # rows x metrics
+        self.series = self.array[:, len(self.metrics):].reshape(rows, len(self.series_names), bins)  # rows x series x bins
+        self.metric_index = {k: j for j, k in enumerate(self.metrics)}
+        self.series_index = {k: j for j, k in enumerate(self.series_names)}
+
+    def spec(self):
+        """ compact description sent to the workers instead of the results """
+        return {'name': self.shm.name, 'metrics': self.metrics, 'series': self.series_names, 'bins': self.bins,
+                'rows': self.rows}
+
+    @classmethod
+    def attach(cls, spec):
+        """ attach to the block described by spec, in a worker """
+        return cls(spec['metrics'], spec['series'], spec['bins'], spec['rows'], name=spec['name'])
+
+    @staticmethod
+    def _open(name, size):
+        if name is None:
+            return shared_memory.SharedMemory(create=True, size=size)
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13 attaching registers the block with the resource tracker of the worker,
+            # which would remove it when the worker exits; only the parent owns the block
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args: None
+            try:
+                return shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+
+    def write(self, row, stats, series=None):
+        """ Write the stats of one replication (see Map.collect_stats and Map.hourly_stats) in a row """
+        for key, value in stats.items():
+            if key not in self.metric_index:
+                raise KeyError('stat {} has no place in the shared results layout'.format(key))
+            self.values[row, self.metric_index[key]] = value
+        for key, values in (series or {}).items():
+            if key not in self.series_index:
+                raise KeyError('stat {} has no place in the shared results layout'.format(key))
+            n = min(len(values), self.bins)
+            self.series[row, self.series_index[key], :n] = values[:n]
+
+    def frame(self, models):
+        """ Wrap the block in a DataFrame without copying the numbers
+        Scalar metrics are float columns over the block and every 30-minute series is a column holding one
+        array per row, each a view of the series block. Stats that no run produced are left out, as are the
+        rows of replications that did not run (e.g. after pruning).
+        Args:
+            models (list) : model name of each row
+        """
+        pd = load_pandas()
+        columns = {}
+        for j, name in enumerate(self.metrics):
+            if not np.isnan(self.values[:, j]).all():
+                columns[name] = self.values[:, j]
+        for j, name in enumerate(self.series_names):
+            if not np.isnan(self.series[:, j, :]).all():
+                column = np.empty(self.rows, dtype=object)
+                column[:] = list(self.series[:, j, :])
+                columns[name] = column
+        df = pd.DataFrame(columns, copy=False)
+        df['model'] = models
+        ran = self.ran()
+        return df if ran.all() else df[ran].reset_index(drop=True)
+
+    def ran(self):
+        """ boolean array of the rows whose replication ran """
+        return ~np.isnan(self.values[:, self.metric_index['iteration']])
+
+    def close(self):
+        """ detach from the block; the parent also removes its name, arrays keep it mapped until they are freed """
+        self.values = self.series = self.array = None
+        self.shm = None
+
+    def unlink(self):
+        self.shm.unlink()
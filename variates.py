@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class VariateStream:
+    """ Hands out variates of one distribution, drawn in blocks from the stream's own generator
+
+    Each block is drawn in a single vectorized call and handed out from a cursor. NumPy draws the
+    variates of a block one after another from the generator, so the sequence does not depend on the
+    block size.
+
+    Args:
+        seed (np.random.SeedSequence or int) : seed of this stream
+        distribution (str) : name of a np.random.Generator method, e.g. 'uniform'
+        params (tuple) : parameters of the distribution
+        block (int) : number of variates drawn at once
+    """
+    def __init__(self, seed, distribution, params, block=4096):
+        self.rng = np.random.default_rng(seed)
+        self.distribution = distribution
+        self.params = params
+        self.block = block
+        self.buffer = []
+        self.cursor = 0
+
+    def next(self):
+        """ returns the next variate as a float """
+        if self.cursor == len(self.buffer):
+            # python floats are faster than numpy scalars in the event loop
+            self.buffer = getattr(self.rng, self.distribution)(*self.params, size=self.block).tolist()
+            self.cursor = 0
+        value = self.buffer[self.cursor]
+        self.cursor += 1
+        return value
+
+
+class Variates:
+    """ Random variate streams of one simulation run, each with an independent seed
+
+    Attributes:
+        boarding (VariateStream): boarding time of one passenger (minutes)
+        driving (VariateStream): driving time of a long leg (minutes)
+    """
+    def __init__(self, seed=None, block=4096):
+        boarding, driving = np.random.SeedSequence(seed).spawn(2)
+        self.boarding = VariateStream(boarding, 'triangular', (0, 1/60, 5/60), block)  # triangular boarding times
+        self.driving = VariateStream(driving, 'uniform', (5, 7), block)                # 20km/hr, +/-1 min variability